@@ -1,57 +1,164 @@
 import os
-import json
+import time
+import inspect
+import threading
 import logging
 import docker
+import orjson
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from datetime import datetime, timedelta
 from flask import Flask, render_template, jsonify, request
-from cassandra.cluster import Cluster
+from flask.json.provider import JSONProvider
+from cassandra.cluster import Cluster, ExecutionProfile, EXEC_PROFILE_DEFAULT
 from cassandra.policies import DCAwareRoundRobinPolicy
+from cassandra.concurrent import execute_concurrent_with_args
 from hdfs import InsecureClient
-from collections import defaultdict
+from hdfs.util import HdfsError
+from concurrent.futures import ThreadPoolExecutor
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - FLASK - %(message)s')
 log = logging.getLogger(__name__)
 
+class OrjsonProvider(JSONProvider):
+    """Provider JSON basato su orjson: jsonify() scrive i bytes direttamente nella risposta."""
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS), mimetype='application/json')
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 CASSANDRA_HOST = os.environ.get('CASSANDRA_HOST', 'cassandra-seed')
 CASSANDRA_KEYSPACE = os.environ.get('CASSANDRA_KEYSPACE', 'iot_keyspace')
 HDFS_HOST = os.environ.get('HDFS_HOST', 'namenode')
 HDFS_PORT = int(os.environ.get('HDFS_PORT', 9870))
 HDFS_USER = os.environ.get('HDFS_USER', 'root')
+# Sensori noti (configurabili senza rebuild): usati quando /data/realtime non riceve sensor_id
+SENSOR_IDS = [s for s in os.environ.get('SENSOR_IDS', 'A1,B1,C1').split(',') if s]
+CASSANDRA_REQUEST_TIMEOUT = 5.0 # secondi
+CASSANDRA_CONNECT_TIMEOUT = 5   # secondi
 
 # Percorsi
 HDFS_DAILY_OUTPUT = '/iot-output/daily-averages' 
 HDFS_STATS_DIR = '/iot-stats/daily-aggregate'
 HDFS_DISCARD_STATS_PATH = '/models/discard_stats.json'
 HDFS_SUMMARY_DIR = '/iot-stats/daily-summary'
+HDFS_READ_BUFFER = 1 << 22 # 4MB, come il buffer lato DataNode
+
+_hdfs = None
 
 def get_hdfs_client():
-    try: return InsecureClient(f"http://{HDFS_HOST}:{HDFS_PORT}", user=HDFS_USER, timeout=5)
-    except: return None
+    """
+    Client HDFS condiviso: una sola sessione HTTP con keep-alive verso il NameNode,
+    riusata da status/read/list invece di aprire una connessione a ogni richiesta.
+    """
+    global _hdfs
+    if _hdfs is None:
+        try:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=Retry(total=2))
+            session.mount('http://', adapter)
+            _hdfs = InsecureClient(f"http://{HDFS_HOST}:{HDFS_PORT}", user=HDFS_USER, timeout=5, session=session)
+        except: return None
+    return _hdfs
+
+def reset_hdfs_client():
+    """Scarta il client dopo un errore di rete: il prossimo get_hdfs_client() si riconnette."""
+    global _hdfs
+    _hdfs = None
 
 # Globali
 cluster = None
 cassandra_session = None
 docker_client = None
+DOCKER_ONE_SHOT = False # Engine API >= 1.41: stats senza il secondo campionamento CPU
+
+# Prepared Statements (preparate una sola volta alla connessione)
+PREP_LATEST = None
+PREP_TREND = None
+PREP_TREND_MINUTE = None
+PREP_SUMMARY = None
 
 # Cache Performance
 last_perf_stats = {}
 last_perf_time = 0
 PERF_CACHE_DURATION = 10 # secondi
+PERF_FETCH_TIMEOUT = 3 # secondi, per singolo container
+CONTAINERS_TO_MONITOR = ['iot-producer', 'dashboard', 'namenode', 'datanode', 'resourcemanager', 'nodemanager', 'cassandra-seed']
+PERF_POOL = ThreadPoolExecutor(max_workers=16)
+
+# Cache Batch / Scarti: i file su HDFS cambiano solo a ogni micro-batch
+batch_cache = {} # (sensor_id, data) -> (istante, metriche)
+BATCH_CACHE_DURATION = 30 # secondi
+BATCH_CACHE_MAX_KEYS = 64
+last_discard_stats = {}
+last_discard_time = 0
+DISCARD_CACHE_DURATION = 15 # secondi
 
 def init_cassandra():
-    global cluster, cassandra_session
-    if cassandra_session: return
+    """Singolo tentativo di connessione; True se la sessione è pronta."""
+    global cluster, cassandra_session, PREP_LATEST, PREP_TREND, PREP_TREND_MINUTE, PREP_SUMMARY
+    if cassandra_session: return True
     try:
-        cluster = Cluster([CASSANDRA_HOST], port=9042, load_balancing_policy=DCAwareRoundRobinPolicy(local_dc='datacenter1'))
-        cassandra_session = cluster.connect(CASSANDRA_KEYSPACE)
-    except: pass
+        # Protocollo v5: fino a 32768 richieste in volo per connessione, niente
+        # head-of-line blocking quando la dashboard fa polling in parallelo
+        profile = ExecutionProfile(
+            load_balancing_policy=DCAwareRoundRobinPolicy(local_dc='datacenter1'),
+            request_timeout=CASSANDRA_REQUEST_TIMEOUT
+        )
+        cluster = Cluster(
+            [CASSANDRA_HOST], port=9042,
+            protocol_version=5,
+            connect_timeout=CASSANDRA_CONNECT_TIMEOUT,
+            execution_profiles={EXEC_PROFILE_DEFAULT: profile}
+        )
+        session = cluster.connect(CASSANDRA_KEYSPACE)
+        # Il piano della query viene parsato dal server una volta sola
+        PREP_LATEST = session.prepare("SELECT temp FROM sensor_data WHERE sensor_id = ? LIMIT 1")
+        PREP_TREND = session.prepare("SELECT toUnixTimestamp(timestamp) AS ts_ms, temp FROM sensor_data WHERE sensor_id = ? AND timestamp >= ? AND timestamp < ?")
+        PREP_TREND_MINUTE = session.prepare("SELECT minute_ts, temp_sum, temp_count FROM sensor_data_minute WHERE sensor_id = ? AND minute_ts >= ?")
+        PREP_SUMMARY = session.prepare("SELECT metrics FROM sensor_daily_summary WHERE sensor_id = ? AND day = ?")
+        cassandra_session = session
+        return True
+    except Exception as e:
+        log.warning(f"Cassandra non raggiungibile: {e}")
+        if cluster:
+            cluster.shutdown()
+            cluster = None
+        return False
+
+def _cassandra_connect_loop():
+    """
+    Riconnessione in background con backoff esponenziale (max 60s):
+    le richieste HTTP non restano mai bloccate in attesa di Cassandra.
+    """
+    attempt = 0
+    while not init_cassandra():
+        time.sleep(min(60, 2 ** attempt))
+        attempt += 1
+    log.info("Connesso a Cassandra.")
+
+threading.Thread(target=_cassandra_connect_loop, daemon=True).start()
 
 def init_docker():
-    global docker_client
+    global docker_client, DOCKER_ONE_SHOT
     if docker_client: return
-    try: docker_client = docker.from_env()
+    try:
+        client = docker.from_env()
+        # Verifica una sola volta se engine e SDK supportano 'one-shot'
+        api_version = tuple(int(x) for x in client.version().get('ApiVersion', '0').split('.'))
+        sdk_support = 'one_shot' in inspect.signature(client.api.stats).parameters
+        DOCKER_ONE_SHOT = api_version >= (1, 41) and sdk_support
+        docker_client = client
     except: pass
 
 # --- ROUTES ---
@@ -61,14 +168,52 @@ def index(): return render_template('index.html')
 
 @app.route('/data/realtime')
 def get_realtime_data():
-    init_cassandra()
-    sensor_id = request.args.get('sensor_id')
-    if not cassandra_session or not sensor_id: return jsonify({"temp": "N/A", "status": "NO_DATA"})
-    try:
-        row = cassandra_session.execute(f"SELECT temp FROM sensor_data WHERE sensor_id = '{sensor_id}' LIMIT 1").one()
-        if row: return jsonify({"temp": row.temp, "status": "ONLINE"})
-    except: pass
-    return jsonify({"temp": "N/A", "status": "NO_DATA"})
+    """
+    Ultimo prezzo di uno o più sensori (es. ?sensor_id=A1 oppure ?sensor_id=A1,B1,C1).
+    Senza sensor_id restituisce tutti i sensori configurati in SENSOR_IDS.
+    Con più sensori le query partono in parallelo sulla stessa sessione.
+    """
+    sensor_ids = [s for s in request.args.get('sensor_id', '').split(',') if s] or SENSOR_IDS
+    if not cassandra_session: return jsonify({"temp": "N/A", "status": "NO_DATA"}), 503
+
+    # Fan-out concorrente con un tetto alle richieste in volo (niente BusyPool)
+    results = execute_concurrent_with_args(
+        cassandra_session, PREP_LATEST, [(sid,) for sid in sensor_ids],
+        concurrency=8, raise_on_first_error=False
+    )
+    latest_data = {}
+    for sid, (success, result) in zip(sensor_ids, results):
+        latest_data[sid] = {"temp": "N/A", "status": "NO_DATA"}
+        row = result.one() if success else None
+        if row: latest_data[sid] = {"temp": row.temp, "status": "ONLINE"}
+
+    if len(sensor_ids) == 1: return jsonify(latest_data[sensor_ids[0]])
+    return jsonify(latest_data)
+
+def _trend_from_raw(sensor_id, since, until):
+    """
+    Fallback: aggrega per MINUTO le righe grezze di sensor_data in [since, until)
+    (la parte di giornata non ancora coperta da sensor_data_minute).
+    """
+    rows = list(cassandra_session.execute(PREP_TREND, (sensor_id, since, until)))
+    if not rows:
+        return []
+
+    # Layout SoA: minuto (int64) e temperatura (float64) in due array contigui.
+    # float64 e non float32: i valori sono prezzi (es. 42000.12), float32 perderebbe i centesimi.
+    n = len(rows)
+    # Il timestamp arriva già come intero (ms): nessun datetime creato per riga
+    minutes = np.fromiter((r.ts_ms // 60000 for r in rows), dtype=np.int64, count=n)
+    temps = np.fromiter((r.temp for r in rows), dtype=np.float64, count=n)
+
+    # Aggregazione per MINUTO (Downsampling): np.unique restituisce i minuti già ordinati
+    uniq, inv = np.unique(minutes, return_inverse=True)
+    means = np.bincount(inv, weights=temps) / np.bincount(inv)
+
+    return [
+        {"x": datetime.utcfromtimestamp(int(m) * 60).isoformat() + 'Z', "y": round(float(avg), 2)}
+        for m, avg in zip(uniq, means)
+    ]
 
 @app.route('/data/realtime/trend')
 def get_realtime_trend():
@@ -76,54 +221,85 @@ def get_realtime_trend():
     Recupera i dati a partire dalla MEZZANOTTE di oggi (Visione Giornaliera).
     Aggrega i dati facendo la media per MINUTO.
     """
-    init_cassandra()
     sensor_id = request.args.get('sensor_id')
+    if not cassandra_session: return jsonify({"data": []}), 503
     try:
         # 1. Calcola l'inizio della giornata odierna (UTC 00:00:00)
         today_midnight = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
-        
-        # 2. Query: Prendi tutto da mezzanotte in poi
-        query = "SELECT timestamp, temp FROM sensor_data WHERE sensor_id = %s AND timestamp >= %s"
-        rows = cassandra_session.execute(query, (sensor_id, today_midnight))
-        
-        # 3. Aggregazione per MINUTO (Downsampling)
-        data_by_minute = defaultdict(list)
-        
-        for r in rows:
-            # Tronca i secondi -> raggruppa per minuto
-            ts_minute = r.timestamp.replace(second=0, microsecond=0)
-            ts_key = ts_minute.isoformat() + 'Z' # Aggiungi Z per UTC esplicito
-            data_by_minute[ts_key].append(r.temp)
-            
-        # 4. Calcola Media per ogni minuto
-        data_points = []
-        for ts, temps in data_by_minute.items():
-            avg_temp = sum(temps) / len(temps)
-            data_points.append({"x": ts, "y": round(avg_temp, 2)})
-            
-        # 5. Ordina per orario (essenziale per il grafico)
-        data_points.sort(key=lambda k: k['x'])
-        
+
+        # 2. Somme per minuto già pre-aggregate dal producer (max 1440 righe al giorno)
+        rows = list(cassandra_session.execute(PREP_TREND_MINUTE, (sensor_id, today_midnight)))
+        data_points = [
+            {"x": r.minute_ts.isoformat() + 'Z', "y": round(r.temp_sum / r.temp_count, 2)}
+            for r in rows if r.temp_count
+        ]
+
+        # 3. Parte di giornata prima della prima riga di riepilogo (es. producer aggiornato
+        # in giornata, o tabella ancora vuota): minuti ricavati dai dati grezzi
+        # (righe in ordine crescente di minute_ts)
+        covered_from = rows[0].minute_ts if rows else datetime.utcnow() + timedelta(minutes=1)
+        if covered_from > today_midnight:
+            data_points = _trend_from_raw(sensor_id, today_midnight, covered_from) + data_points
+
         return jsonify({"data": data_points})
-        
+
     except Exception as e: 
         log.error(f"Trend Error: {e}")
         return jsonify({"data": []})
 
+def _find_sensor_metrics(client, path, sensor_id):
+    """Cerca la riga 'SENSORE-DAILY \t JSON' del sensore in un file di riepilogo."""
+    # File letto in un colpo solo e diviso in memoria (niente iterazione a chunk da 8KB)
+    with client.read(path, buffer_size=HDFS_READ_BUFFER) as r:
+        raw = r.read()
+    prefix = f"{sensor_id}-".encode()
+    for line in raw.splitlines():
+        if line.startswith(prefix):
+            key, sep, payload = line.partition(b'\t')
+            if sep:
+                return orjson.loads(payload)
+    return None
+
 @app.route('/data/batch')
 def get_batch_data():
+    """
+    Metriche giornaliere di un sensore (?sensor_id=A1, opzionale &date=YYYY-MM-DD, default oggi).
+    Il path della partizione è costruito direttamente: nessun listing delle directory.
+    """
     client = get_hdfs_client()
-    sensor_id = request.args.get('sensor_id')
-    today = datetime.utcnow().strftime('%Y-%m-%d')
-    path = f"{HDFS_SUMMARY_DIR}/date={today}/daily_stats.json"
+    sensor_id = request.args.get('sensor_id', '')
+    day = request.args.get('date') or datetime.utcnow().strftime('%Y-%m-%d')
+    try: datetime.strptime(day, '%Y-%m-%d')
+    except ValueError: return jsonify({"status": "Data non valida"}), 400
+    if not sensor_id.isalnum(): return jsonify({"status": "Calcolo in corso..."})
+
+    # Cache Check
+    cached = batch_cache.get((sensor_id, day))
+    if cached and time.time() - cached[0] < BATCH_CACHE_DURATION:
+        return jsonify({day: cached[1]})
+
+    partition = f"{HDFS_SUMMARY_DIR}/date={day}"
     try:
-        with client.read(path, encoding='utf-8') as r:
-            for line in r:
-                if line.startswith(f"{sensor_id}-"):
-                    parts = line.split('\t', 1)
-                    if len(parts) > 1:
-                        metrics = json.loads(parts[1])
-                        return jsonify({today: metrics})
+        # 1. Riepilogo pubblicato su Cassandra da run_job.sh: lookup per chiave primaria
+        metrics = None
+        if cassandra_session:
+            try:
+                row = cassandra_session.execute(PREP_SUMMARY, (sensor_id, day)).one()
+                if row: metrics = orjson.loads(row.metrics)
+            except Exception: pass
+        # 2. File dedicato al sensore su HDFS: una sola riga da leggere
+        if metrics is None:
+            try: metrics = _find_sensor_metrics(client, f"{partition}/sensor={sensor_id}/daily_stats.json", sensor_id)
+            except HdfsError: metrics = None
+        # 3. Fallback: file unico con tutti i sensori
+        if metrics is None:
+            metrics = _find_sensor_metrics(client, f"{partition}/daily_stats.json", sensor_id)
+        if metrics is not None:
+            # Update Cache
+            if len(batch_cache) >= BATCH_CACHE_MAX_KEYS: batch_cache.clear()
+            batch_cache[(sensor_id, day)] = (time.time(), metrics)
+            return jsonify({day: metrics})
+    except (IOError, requests.RequestException): reset_hdfs_client()
     except Exception: pass
     return jsonify({"status": "Calcolo in corso..."})
 
@@ -134,47 +310,69 @@ def get_aggregate_stats():
     today = datetime.utcnow().strftime('%Y-%m-%d')
     path = f"{HDFS_STATS_DIR}/date={today}/aggregate_stats.json"
     try:
-        with client.read(path, encoding='utf-8') as r:
-            data = json.load(r)
+        with client.read(path) as r:
+            data = orjson.loads(r.read())
             response.update(data)
+    except (IOError, requests.RequestException): reset_hdfs_client()
     except: pass
     return jsonify(response)
 
 @app.route('/data/discard_stats')
 def get_discard_stats():
+    global last_discard_stats, last_discard_time
+
+    # Cache Check
+    if time.time() - last_discard_time < DISCARD_CACHE_DURATION and last_discard_stats:
+        return jsonify(last_discard_stats)
+
     client = get_hdfs_client()
     response = {"total": 0}
     try:
         if client.status(HDFS_DISCARD_STATS_PATH, strict=False):
-            with client.read(HDFS_DISCARD_STATS_PATH, encoding='utf-8') as r:
+            with client.read(HDFS_DISCARD_STATS_PATH) as r:
                 content = r.read()
                 if content:
-                    data = json.loads(content)
+                    data = orjson.loads(content)
                     response["total"] = data.get("total", 0)
+        # Update Cache (solo letture riuscite)
+        last_discard_stats = response
+        last_discard_time = time.time()
+    except (IOError, requests.RequestException): reset_hdfs_client()
     except: pass
     return jsonify(response)
 
+def _fetch_container_stats(name):
+    """Legge memoria e rete di un container (chiamata bloccante sul socket Docker)."""
+    try:
+        if DOCKER_ONE_SHOT:
+            # Un solo frame JSON: usiamo solo memoria/rete, il delta CPU non serve
+            s = docker_client.api.stats(name, stream=False, one_shot=True)
+        else:
+            s = docker_client.containers.get(name).stats(stream=False)
+        mem = s['memory_stats'].get('usage', 0) / 1024**2
+        net = s.get('networks', {})
+        rx = sum(v['rx_bytes'] for v in net.values()) / 1024**2
+        tx = sum(v['tx_bytes'] for v in net.values()) / 1024**2
+        return {"mem_mb": round(mem, 2), "net_rx_mb": round(rx, 2), "net_tx_mb": round(tx, 2)}
+    except: return {"mem_mb": 0, "net_rx_mb": 0, "net_tx_mb": 0}
+
 @app.route('/data/performance')
 def get_perf():
     global last_perf_stats, last_perf_time
     
     # Cache Check
-    import time
     if time.time() - last_perf_time < PERF_CACHE_DURATION and last_perf_stats:
         return jsonify(last_perf_stats)
 
     init_docker()
     if not docker_client: return jsonify({})
+
+    # stats() attende ~1s per container: le richieste partono tutte insieme,
+    # la latenza totale diventa quella del container più lento
+    futs = {name: PERF_POOL.submit(_fetch_container_stats, name) for name in CONTAINERS_TO_MONITOR}
     stats = {}
-    for name in ['iot-producer', 'dashboard', 'namenode', 'datanode', 'resourcemanager', 'nodemanager', 'cassandra-seed']:
-        try:
-            c = docker_client.containers.get(name)
-            s = c.stats(stream=False)
-            mem = s['memory_stats'].get('usage', 0) / 1024**2
-            net = s.get('networks', {})
-            rx = sum(v['rx_bytes'] for v in net.values()) / 1024**2
-            tx = sum(v['tx_bytes'] for v in net.values()) / 1024**2
-            stats[name] = {"mem_mb": round(mem, 2), "net_rx_mb": round(rx, 2), "net_tx_mb": round(tx, 2)}
+    for name, f in futs.items():
+        try: stats[name] = f.result(timeout=PERF_FETCH_TIMEOUT)
         except: stats[name] = {"mem_mb": 0, "net_rx_mb": 0, "net_tx_mb": 0}
     
     # Update Cache
@@ -0,0 +1,12 @@
+# Configurazione gunicorn per il dashboard.
+# Gli endpoint sono I/O-bound (Docker socket, HDFS, Cassandra): i worker 'gthread'
+# permettono a più richieste di sovrapporre le attese.
+# Niente preload: le connessioni (Cassandra, HDFS, Docker) vengono create
+# pigramente dentro ogni worker, dopo il fork.
+bind = "0.0.0.0:5000"
+workers = 2
+worker_class = "gthread"
+threads = 16
+keepalive = 30
+timeout = 60
+accesslog = "-"
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+publish_summary.py
+Legge da stdin l'output di unify_batches.py (SENSORE-DAILY \t JSON) e pubblica
+le metriche giornaliere nella tabella Cassandra 'sensor_daily_summary'.
+Uso: publish_summary.py YYYY-MM-DD < daily_unified.json
+"""
+import os
+import sys
+from cassandra.cluster import Cluster
+from cassandra.policies import DCAwareRoundRobinPolicy
+from cassandra.concurrent import execute_concurrent_with_args
+
+CASSANDRA_HOST = os.environ.get('CASSANDRA_HOST', 'cassandra-seed')
+CASSANDRA_KEYSPACE = os.environ.get('CASSANDRA_KEYSPACE', 'iot_keyspace')
+SUMMARY_TTL = 2592000 # 30 giorni
+
+def read_summary(stream, day):
+    """Una tupla (sensor_id, giorno, metriche JSON) per ogni riga valida."""
+    rows = []
+    for line in stream:
+        key, sep, metrics = line.strip().partition('\t')
+        if sep and metrics:
+            rows.append((key.split('-')[0], day, metrics))
+    return rows
+
+def main():
+    if len(sys.argv) < 2:
+        print("Uso: publish_summary.py YYYY-MM-DD", file=sys.stderr)
+        sys.exit(1)
+
+    rows = read_summary(sys.stdin, sys.argv[1])
+    if not rows:
+        return
+
+    cluster = Cluster(
+        [CASSANDRA_HOST], port=9042,
+        load_balancing_policy=DCAwareRoundRobinPolicy(local_dc='datacenter1')
+    )
+    try:
+        session = cluster.connect(CASSANDRA_KEYSPACE)
+        insert = session.prepare(
+            "INSERT INTO sensor_daily_summary (sensor_id, day, metrics) VALUES (?, ?, ?) "
+            "USING TTL {}".format(SUMMARY_TTL)
+        )
+        results = execute_concurrent_with_args(session, insert, rows, concurrency=16, raise_on_first_error=False)
+        failed = sum(1 for success, _ in results if not success)
+        if failed:
+            print("publish_summary: {} righe non scritte su {}".format(failed, len(rows)), file=sys.stderr)
+            sys.exit(1)
+    finally:
+        cluster.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -6,12 +6,50 @@ Carica 'model.json' per pulire (filtrare) i dati.
 Calcola metriche OHLC e statistiche sui dati PULITI.
 Aggiunge il conteggio dei dati SCARTATI.
 
+NumPy e Numba sono opzionali: accelerano la riduzione delle chiavi grandi ma
+danno gli stessi risultati del percorso in puro Python. In tutti e tre i
+percorsi le temperature non finite (NaN, +/-inf) contano come scartate.
+
 Emette: CHIAVE \t JSON_METRICS
+Con --combine (usato come combiner): CHIAVE \t STATO_PARZIALE
 """
 
+import io
 import sys
+import atexit
+from array import array
 import json
 import math
+from itertools import islice, groupby
+from operator import itemgetter
+
+# Serializzatore JSON in C se disponibile sul nodo, altrimenti la libreria standard
+# (json resta per il solo caricamento di model.json)
+try:
+    from orjson import dumps as _orjson_dumps
+    def _dumps(obj):
+        return _orjson_dumps(obj).decode()
+except ImportError:
+    _dumps = json.dumps
+
+# NumPy è opzionale: senza, il reducer usa il percorso in puro Python
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Numba (opzionale, richiede NumPy): kernel compilato per la riduzione di una chiave
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+CHUNK_LINES = 65536
+# Sotto questa soglia di punti per chiave il costo di conversione in array
+# supera il guadagno: si resta sul percorso in puro Python
+NUMPY_MIN_VALUES = 64
+# Buffer di I/O: poche write() da 1MB invece di una syscall per riga
+IO_BUFFER_SIZE = 1 << 20
 
 # --- Carica il modello di pulizia ---
 MODEL_FILE = 'model.json'
@@ -26,170 +64,416 @@ except FileNotFoundError:
 except Exception as e:
     print("Errore nel caricamento di model.json: {}".format(e), file=sys.stderr)
     pass
+
+# Limiti 3-sigma per sensore, calcolati una sola volta (il modello non cambia durante il job).
+# Il filtro si applica SOLO se std_dev è significativo (maggiore di ~0): se è 0
+# scarterebbe tutti i dati, quindi il sensore resta fuori dalla tabella e i dati si tengono.
+# Senza limiti valgono comunque quelli dei float finiti: lower <= x <= upper
+# è falso per NaN e +/-inf, stessa regola in tutti i percorsi.
+BOUNDS = {}
+NO_BOUNDS = (-sys.float_info.max, sys.float_info.max)
+for _sid, _params in anomaly_model.items():
+    try:
+        if _params['std_dev'] > 0.0001:
+            BOUNDS[_sid] = (_params['mean'] - (3 * _params['std_dev']),
+                            _params['mean'] + (3 * _params['std_dev']))
+    except (KeyError, TypeError):
+        print("Parametri non validi nel modello per {}: ignorati".format(_sid), file=sys.stderr)
 # --- Fine ---
 
 
-# Variabili per tracciare il gruppo corrente
-current_key = None
-current_values = [] # Lista per (timestamp, temp)
+# --- Stato parziale di una chiave ---
+# Lista di 10 campi, fondibile (merge) in qualsiasi ordine: permette di usare
+# questo stesso script come combiner (--combine) prima dello shuffle.
+#   [count, discarded, mean, m2, min, max, open_ts, open, close_ts, close]
+# count/mean/m2/min/max/open/close si riferiscono ai soli dati PULITI;
+# m2 è la somma dei quadrati degli scarti dalla media (Welford/Chan).
+# Se count == 0 i campi min..close valgono None.
+PARTIAL_FIELDS = 10
 
-def calculate_metrics_and_print(key, values):
+def reduce_values(sensor_id, timestamps, prices):
     """
-    Funzione helper per calcolare le metriche e stampare il JSON.
+    Filtra i punti grezzi di una chiave con il modello e li riduce a uno stato parziale.
+    timestamps/prices sono due array paralleli (array('q') / array('d')).
     """
-    if not values:
-        return
-    
-    try:
-        # --- Filtra i dati prima dei calcoli ---
-        sensor_id = key.split('-', 1)[0]
-        model_params = anomaly_model.get(sensor_id)
-        
-        cleaned_values = []
-        discarded_count = 0
-        total_count = len(values) # Conteggio totale prima della pulizia
-
-        # --- INIZIO CORREZIONE LOGICA (Versione 2) ---
-        
-        # Se non c'è modello, considera tutti i dati como puliti
-        if not model_params:
-            cleaned_values = values
-            discarded_count = 0
+    if np is not None and len(prices) >= NUMPY_MIN_VALUES:
+        return reduce_values_numpy(sensor_id, timestamps, prices)
+
+    bounds = BOUNDS.get(sensor_id)
+    # Senza limiti (nessun modello o std_dev ~0) tutti i dati sono "puliti"
+    lower_bound, upper_bound = bounds if bounds is not None else NO_BOUNDS
+
+    # Un solo passaggio, senza ordinare: filtro, min/max, apertura e chiusura
+    # (prezzi al timestamp minimo e massimo) e varianza di Welford
+    count = 0
+    mean = 0.0
+    m2 = 0.0
+    for timestamp, temp in zip(timestamps, prices):
+        if not (lower_bound <= temp <= upper_bound):
+            continue # Scarta anomalia (e valori non finiti)
+        count += 1
+        delta = temp - mean
+        mean += delta / count
+        m2 += (temp - mean) * delta
+        if count == 1:
+            min_t = max_t = temp
+            open_ts = close_ts = timestamp
+            open_price = close_price = temp
         else:
-            # Se c'è un modello, controlla la std_dev
-            mean = model_params['mean']
-            std_dev = model_params['std_dev']
-
-            # Applica il filtro SOLO se std_dev è significativo (maggiore di ~0)
-            # Se è 0, il filtro scarterebbe tutti i dati, quindi li teniamo.
-            if std_dev > 0.0001: 
-                lower_bound = mean - (3 * std_dev)
-                upper_bound = mean + (3 * std_dev)
-                
-                for (timestamp, temp) in values:
-                    if (temp < lower_bound) or (temp > upper_bound):
-                        discarded_count += 1 # Scarta anomalia
-                    else:
-                        cleaned_values.append((timestamp, temp)) # Dato pulito
-            else:
-                # Se std_dev è 0.0 (o troppo piccolo), tutti i dati sono "puliti"
-                cleaned_values = values
-                discarded_count = 0
-        
-        # --- FINE CORREZIONE ---
-
-        # Se tutti i dati sono stati scartati, invece di tornare senza output
-        # emetti comunque un JSON con i conteggi (count=0) in modo che
-        # i passi successivi (aggregate_stats.py) possano contabilizzare
-        # correttamente i dati scartati.
-        if not cleaned_values:
-            # Log diagnostico
-            print("Dati scartati per {}: Totali={}, Puliti=0".format(key, total_count), file=sys.stderr)
-
-            # Costruisci un oggetto metrics minimale: nessuna metrica numerica utile
-            # ma con i conteggi per consentire l'aggregazione
-            metrics = {
-                "open": None,
-                "close": None,
-                "min": None,
-                "max": None,
-                "count": 0,
-                "total_count": total_count,
-                "discarded_count": discarded_count,
-                "discarded_pct": round((discarded_count / total_count) * 100, 2) if total_count > 0 else 0,
-                "daily_change": None,
-                "daily_change_pct": None,
-                "range_pct": None,
-                "volatility": None,
-                "trend": 0
-            }
-
-            # Stampa comunque la riga attesa da downstream: CHIAVE \t JSON
-            print("{}\t{}".format(key, json.dumps(metrics)))
-            return
-
-        # 1. Ordina i dati puliti per timestamp (crescente)
-        cleaned_values.sort(key=lambda x: x[0])
-        
-        # Estrai solo le temperature per i calcoli
-        temps = [v[1] for v in cleaned_values]
-        
-        # 2. Calcola metriche OHLC
-        open_price = cleaned_values[0][1]
-        close_price = cleaned_values[-1][1]
-        min_price = min(temps)
-        max_price = max(temps)
-        count = len(temps)
-        
-        # 3. Calcola statistiche aggiuntive
-        discarded_pct = (discarded_count / total_count) * 100 if total_count > 0 else 0
-        
-        daily_change = close_price - open_price
-        daily_change_pct = (daily_change / open_price) * 100 if open_price > 0 else 0
-        
-        price_range = max_price - min_price
-        range_pct = (price_range / open_price) * 100 if open_price > 0 else 0
-        
-        # Volatilità (deviazione standard dei prezzi puliti)
-        if count > 1:
-            mean = sum(temps) / count
-            variance = sum((x - mean) ** 2 for x in temps) / (count - 1)
-            volatility = math.sqrt(variance)
+            if temp < min_t: min_t = temp
+            if temp > max_t: max_t = temp
+            # Come l'ordinamento stabile: a parità di timestamp apre il primo e chiude l'ultimo
+            if timestamp < open_ts:
+                open_ts, open_price = timestamp, temp
+            if timestamp >= close_ts:
+                close_ts, close_price = timestamp, temp
+
+    discarded_count = len(prices) - count
+    if count == 0:
+        return [0, discarded_count, 0.0, 0.0, None, None, None, None, None, None]
+
+    return [count, discarded_count, mean, m2, min_t, max_t,
+            open_ts, open_price, close_ts, close_price]
+
+def reduce_values_numpy(sensor_id, timestamps, prices):
+    """
+    Come reduce_values, ma filtro e statistiche sono calcolati su array NumPy
+    (timestamp int64, prezzi float64) invece che con cicli Python.
+    """
+    # Viste sui buffer array.array: nessuna copia
+    n = len(prices)
+    ts = np.frombuffer(timestamps, dtype=np.int64)
+    temps = np.frombuffer(prices, dtype=np.float64)
+
+    if reduce_kernel is not None:
+        return reduce_values_jit(ts, temps, sensor_id)
+
+    # Stesso filtro di reduce_values (anche senza modello: scarta NaN e +/-inf)
+    lower_bound, upper_bound = BOUNDS.get(sensor_id, NO_BOUNDS)
+    mask = (temps >= lower_bound) & (temps <= upper_bound)
+    if not mask.all():
+        ts = ts[mask]
+        temps = temps[mask]
+
+    count = len(temps)
+    discarded_count = n - count
+    if count == 0:
+        return [0, discarded_count, 0.0, 0.0, None, None, None, None, None, None]
+
+    # Apertura/chiusura senza ordinare: primo indice del timestamp minimo
+    # e ultimo indice del massimo (come l'ordinamento stabile)
+    open_i = int(np.argmin(ts))
+    close_i = count - 1 - int(np.argmax(ts[::-1]))
+
+    mean = float(temps.mean())
+    m2 = float(temps.var()) * count
+
+    return [count, discarded_count, mean, m2, float(temps.min()), float(temps.max()),
+            int(ts[open_i]), float(temps[open_i]), int(ts[close_i]), float(temps[close_i])]
+
+def _reduce_kernel(ts, temps, lower_bound, upper_bound):
+    """
+    Un solo passaggio sugli array: filtro, OHLC (senza ordinamento, tenendo
+    gli indici del timestamp minimo e massimo) e varianza di Welford.
+    """
+    count = 0
+    mean = 0.0
+    m2 = 0.0
+    min_t = 0.0
+    max_t = 0.0
+    open_i = -1
+    close_i = -1
+    for i in range(len(temps)):
+        x = temps[i]
+        if not (x >= lower_bound and x <= upper_bound):
+            continue
+        count += 1
+        delta = x - mean
+        mean += delta / count
+        m2 += (x - mean) * delta
+        if count == 1:
+            min_t = x
+            max_t = x
+            open_i = i
+            close_i = i
         else:
-            volatility = 0
-            
-        # Trend (semplice, +1 se chiude più alto, -1 se più basso)
-        trend = 0
-        if daily_change > 0: trend = 1
-        elif daily_change < 0: trend = -1
-
-        # 4. Crea l'oggetto JSON di output
+            if x < min_t: min_t = x
+            if x > max_t: max_t = x
+            # Come l'ordinamento stabile: a parità di timestamp apre il primo e chiude l'ultimo
+            if ts[i] < ts[open_i]: open_i = i
+            if ts[i] >= ts[close_i]: close_i = i
+    return count, mean, m2, min_t, max_t, open_i, close_i
+
+reduce_kernel = None
+if njit is not None and np is not None:
+    try:
+        reduce_kernel = njit(cache=True)(_reduce_kernel)
+        # Compilazione subito all'avvio del task, non alla prima chiave
+        # (con viste in sola lettura, come quelle di np.frombuffer)
+        reduce_kernel(np.frombuffer(array('q', [0, 0]), dtype=np.int64),
+                      np.frombuffer(array('d', [0.0, 0.0]), dtype=np.float64), NO_BOUNDS[0], NO_BOUNDS[1])
+    except Exception as e:
+        print("Numba non utilizzabile, uso NumPy: {}".format(e), file=sys.stderr)
+        reduce_kernel = None
+
+def reduce_values_jit(ts, temps, sensor_id):
+    """Riduzione di una chiave con il kernel Numba (array timestamp/prezzi)."""
+    lower_bound, upper_bound = BOUNDS.get(sensor_id, NO_BOUNDS)
+
+    count, mean, m2, min_t, max_t, open_i, close_i = reduce_kernel(ts, temps, lower_bound, upper_bound)
+    discarded_count = len(temps) - count
+    if count == 0:
+        return [0, discarded_count, 0.0, 0.0, None, None, None, None, None, None]
+
+    return [count, discarded_count, mean, m2, min_t, max_t,
+            int(ts[open_i]), float(temps[open_i]), int(ts[close_i]), float(temps[close_i])]
+
+def merge_states(a, b):
+    """
+    Fonde due stati parziali (a precede b nell'ordine di arrivo).
+    Media e m2 vengono combinate con la formula parallela di Chan.
+    """
+    if b[0] == 0:
+        a[1] += b[1]
+        return a
+    if a[0] == 0:
+        b[1] += a[1]
+        return b
+
+    count = a[0] + b[0]
+    delta = b[2] - a[2]
+    mean = a[2] + delta * b[0] / count
+    m2 = a[3] + b[3] + delta * delta * a[0] * b[0] / count
+
+    # A parità di timestamp vince il primo arrivato per l'apertura
+    # e l'ultimo per la chiusura (come l'ordinamento stabile)
+    first = a if a[6] <= b[6] else b
+    last = b if b[8] >= a[8] else a
+
+    return [count, a[1] + b[1], mean, m2, min(a[4], b[4]), max(a[5], b[5]),
+            first[6], first[7], last[8], last[9]]
+
+def format_partial(state):
+    """Serializza uno stato parziale come 'c|d|mean|m2|min|max|ots|open|cts|close'."""
+    return '|'.join('' if v is None else repr(v) for v in state)
+
+def parse_partial(fields):
+    """Inverso di format_partial (riceve i campi già divisi su '|', str o bytes)."""
+    state = [int(fields[0]), int(fields[1]), float(fields[2]), float(fields[3])]
+    for i, v in enumerate(fields[4:], 4):
+        if not v:
+            state.append(None)
+        elif i in (6, 8):
+            state.append(int(v))
+        else:
+            state.append(float(v))
+    return state
+
+# Schema fisso del JSON delle metriche (stesso ordine dei campi di sempre).
+# L'arrotondamento a 2 decimali avviene nella formattazione ({:.2f}, stesso
+# risultato di round(x, 2)); {!r} dà la rappresentazione più corta del float.
+# count: Osservazioni Pulite, total_count: Totali, discarded_count: Scartate
+# Valido solo con valori finiti: altrimenti {:.2f} scriverebbe inf/nan (JSON non valido).
+METRICS_JSON = (
+    '{{"open":{:.2f},"close":{:.2f},"min":{:.2f},"max":{:.2f},'
+    '"count":{},"total_count":{},"discarded_count":{},"discarded_pct":{!r},'
+    '"daily_change":{:.2f},"daily_change_pct":{:.2f},"range_pct":{:.2f},'
+    '"volatility":{:.2f},"trend":{}}}'
+)
+
+def calculate_metrics_and_print(key, state):
+    """
+    Funzione helper per calcolare le metriche finali dallo stato e stampare il JSON.
+    """
+    count, discarded_count = state[0], state[1]
+    total_count = count + discarded_count # Conteggio totale prima della pulizia
+
+    # Se tutti i dati sono stati scartati, invece di tornare senza output
+    # emetti comunque un JSON con i conteggi (count=0) in modo che
+    # i passi successivi (aggregate_stats.py) possano contabilizzare
+    # correttamente i dati scartati.
+    if count == 0:
+        # Log diagnostico
+        print("Dati scartati per {}: Totali={}, Puliti=0".format(key, total_count), file=sys.stderr)
+
+        # Costruisci un oggetto metrics minimale: nessuna metrica numerica utile
+        # ma con i conteggi per consentire l'aggregazione
         metrics = {
-            "open": round(open_price, 2),
-            "close": round(close_price, 2),
-            "min": round(min_price, 2),
-            "max": round(max_price, 2),
-            "count": count, # Osservazioni Pulite
-            "total_count": total_count, # Osservazioni Totali
-            "discarded_count": discarded_count, # Osservazioni Scartate
-            "discarded_pct": discarded_pct,
-            "daily_change": round(daily_change, 2),
-            "daily_change_pct": round(daily_change_pct, 2),
-            "range_pct": round(range_pct, 2),
-            "volatility": round(volatility, 2),
-            "trend": trend
+            "open": None,
+            "close": None,
+            "min": None,
+            "max": None,
+            "count": 0,
+            "total_count": total_count,
+            "discarded_count": discarded_count,
+            "discarded_pct": round((discarded_count / total_count) * 100, 2) if total_count > 0 else 0,
+            "daily_change": None,
+            "daily_change_pct": None,
+            "range_pct": None,
+            "volatility": None,
+            "trend": 0
         }
-        
-        # 5. Stampa il risultato
-        print("{}\t{}".format(key, json.dumps(metrics)))
 
-    except Exception as e:
-        print("Errore nel calcolo delle metriche per {}: {}".format(key, e), file=sys.stderr)
+        # Stampa comunque la riga attesa da downstream: CHIAVE \t JSON
+        sys.stdout.write(key + '\t' + _dumps(metrics) + '\n')
+        return
 
+    # 1. Metriche OHLC (dallo stato: apertura/chiusura già per timestamp)
+    open_price = state[7]
+    close_price = state[9]
+    min_price = state[4]
+    max_price = state[5]
 
-# --- Loop principale del Reducer (invariato) ---
+    # 2. Calcola statistiche aggiuntive
+    discarded_pct = (discarded_count / total_count) * 100 if total_count > 0 else 0
+
+    daily_change = close_price - open_price
+    daily_change_pct = (daily_change / open_price) * 100 if open_price > 0 else 0
+
+    price_range = max_price - min_price
+    range_pct = (price_range / open_price) * 100 if open_price > 0 else 0
+
+    # Volatilità (deviazione standard campionaria dei prezzi puliti)
+    if count > 1:
+        variance = state[3] / (count - 1)
+        # m2 non finito (overflow su valori estremi): volatilità non definita -> null
+        volatility = math.sqrt(variance) if variance >= 0 else math.nan
+    else:
+        volatility = 0
+
+    # Trend (semplice, +1 se chiude più alto, -1 se più basso)
+    trend = 0
+    if daily_change > 0: trend = 1
+    elif daily_change < 0: trend = -1
+
+    # 3. Crea il JSON di output direttamente dallo schema fisso (nessun dict intermedio)
+    values = (open_price, close_price, min_price, max_price, discarded_pct,
+              daily_change, daily_change_pct, range_pct, volatility)
+    if all(map(math.isfinite, values)):
+        payload = METRICS_JSON.format(
+            open_price, close_price, min_price, max_price,
+            count, total_count, discarded_count, discarded_pct,
+            daily_change, daily_change_pct, range_pct, volatility, trend
+        )
+    else:
+        # Caso degenere (es. overflow): i valori non finiti diventano null
+        def r2(x):
+            return round(x, 2) if math.isfinite(x) else None
+        payload = _dumps({
+            "open": r2(open_price), "close": r2(close_price),
+            "min": r2(min_price), "max": r2(max_price),
+            "count": count, "total_count": total_count, "discarded_count": discarded_count,
+            "discarded_pct": discarded_pct if math.isfinite(discarded_pct) else None,
+            "daily_change": r2(daily_change), "daily_change_pct": r2(daily_change_pct),
+            "range_pct": r2(range_pct), "volatility": r2(volatility), "trend": trend
+        })
+
+    # 4. Stampa il risultato
+    sys.stdout.write(key + '\t' + payload + '\n')
+
+def flush_key(key, timestamps, prices, partials, combine):
+    """
+    Riduce i punti grezzi di una chiave, fonde gli eventuali stati parziali
+    (prodotti dal combiner) e stampa lo stato (--combine) o le metriche finali.
+    La chiave arriva in bytes da stdin e viene decodificata una volta per gruppo.
+    """
+    if not prices and not partials:
+        return
+
+    key = key.decode('utf-8', 'replace')
 
-for line in sys.stdin:
     try:
-        line = line.strip()
-        key, value_str = line.split('\t', 1)
-        temp, timestamp = value_str.split('|')
-        
-        temp = float(temp)
-        timestamp = int(timestamp)
-
-        if current_key == key:
-            current_values.append((timestamp, temp))
+        state = reduce_values(key.split('-', 1)[0], timestamps, prices)
+        for partial in partials:
+            state = merge_states(state, partial)
+
+        if combine:
+            sys.stdout.write(key + '\t' + format_partial(state) + '\n')
         else:
-            if current_key:
-                calculate_metrics_and_print(current_key, current_values)
-            
-            current_key = key
-            current_values = [(timestamp, temp)]
-
-    except Exception:
-        pass # Ignora righe malformate
-
-# Processa l'ultimo gruppo
-if current_key:
-    calculate_metrics_and_print(current_key, current_values)
\ No newline at end of file
+            calculate_metrics_and_print(key, state)
+
+    except Exception as e:
+        print("Errore nel calcolo delle metriche per {}: {}".format(key, e), file=sys.stderr)
+
+
+# --- Loop principale del Reducer ---
+
+def parse_chunk(lines):
+    """
+    Converte un blocco di righe in tuple (chiave, timestamp, temp, parziale).
+    Righe del mapper:   'CHIAVE \t TEMP|TIMESTAMP' -> parziale None
+    Righe del combiner: 'CHIAVE \t STATO_PARZIALE' -> timestamp/temp None
+    TIMESTAMP sono i secondi dalla mezzanotte (la data è nella chiave).
+    Le righe malformate vengono ignorate.
+    Le righe sono bytes: niente decodifica UTF-8 né strip() per record,
+    solo partition (int() e float() accettano bytes e ignorano il '\n' finale).
+    """
+    records = []
+    append = records.append
+    for line in lines:
+        key, sep, value = line.partition(b'\t')
+        if not sep:
+            continue
+        try:
+            temp, _, timestamp = value.partition(b'|')
+            if b'|' not in timestamp:
+                append((key, int(timestamp), float(temp), None))
+            else:
+                fields = value.rstrip().split(b'|')
+                if len(fields) == PARTIAL_FIELDS:
+                    append((key, None, None, parse_partial(fields)))
+        except ValueError:
+            pass # Ignora righe malformate
+    return records
+
+def setup_buffered_io():
+    """
+    Sostituisce stdin (binario) e stdout (UTF-8) con stream a buffer grande
+    (flush garantito all'uscita).
+    """
+    sys.stdin = io.open(sys.stdin.fileno(), 'rb', buffering=IO_BUFFER_SIZE, closefd=False)
+    sys.stdout = io.open(sys.stdout.fileno(), 'w', buffering=IO_BUFFER_SIZE,
+                         encoding='utf-8', closefd=False)
+    atexit.register(sys.stdout.flush)
+
+def main():
+    # --combine: emette stati parziali invece del JSON finale (uso come combiner)
+    combine = '--combine' in sys.argv[1:]
+    setup_buffered_io()
+    current_key = None
+    # Layout SoA: timestamp e prezzi in due buffer tipizzati (16 byte per punto,
+    # niente tuple), convertiti in NumPy senza copia
+    current_ts = array('q')
+    current_prices = array('d')
+    current_partials = [] # Stati parziali dal combiner
+
+    # stdin letto a blocchi di CHUNK_LINES righe: il raggruppamento per chiave
+    # avviene con groupby (in C) invece di un confronto Python riga per riga
+    while True:
+        chunk = list(islice(sys.stdin, CHUNK_LINES))
+        if not chunk:
+            break
+
+        for key, group in groupby(parse_chunk(chunk), key=itemgetter(0)):
+            # Un gruppo può proseguire dal blocco precedente
+            if key != current_key:
+                if current_key:
+                    flush_key(current_key, current_ts, current_prices, current_partials, combine)
+                current_key = key
+                current_ts = array('q')
+                current_prices = array('d')
+                current_partials = []
+
+            for _, timestamp, temp, partial in group:
+                if partial is None:
+                    current_ts.append(timestamp)
+                    current_prices.append(temp)
+                else:
+                    current_partials.append(partial)
+
+    # Processa l'ultimo gruppo
+    if current_key:
+        flush_key(current_key, current_ts, current_prices, current_partials, combine)
+
+if __name__ == "__main__":
+    main()
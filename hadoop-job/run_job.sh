@@ -23,18 +23,22 @@ CURRENT_TIME=$(date +%H-%M-%S)
 
 log() { echo "$(date +'%Y-%m-%d %H:%M:%S') - $1"; }
 
+# Batch del producer: .jsonl.gz (compressi) oppure .jsonl (archivi precedenti)
+BATCH_GLOB="*.jsonl*"
+
 # --- 0. CHECK MICRO-BATCH ---
-if ! $HDFS_CMD dfs -fs $HDFS_URI -test -e "$INCOMING_DIR/*.jsonl"; then
+if ! $HDFS_CMD dfs -fs $HDFS_URI -test -e "$INCOMING_DIR/$BATCH_GLOB"; then
     exit 0
 fi
 
 log "🚀 Avvio Micro-Batch $CURRENT_TIME su dati nuovi..."
 
 # --- FASE 1: TRAINING ---
+# -text invece di -cat: decomprime i .gz (i file non compressi passano invariati)
 {
-  $HDFS_CMD dfs -fs $HDFS_URI -cat "$ARCHIVE_DIR_BASE/date=$YESTERDAY_DATE/*.jsonl" 2>/dev/null
-  $HDFS_CMD dfs -fs $HDFS_URI -cat "$ARCHIVE_DIR_BASE/date=$TODAY_DATE/*.jsonl" 2>/dev/null
-  $HDFS_CMD dfs -fs $HDFS_URI -cat "$INCOMING_DIR/*.jsonl" 2>/dev/null
+  $HDFS_CMD dfs -fs $HDFS_URI -text "$ARCHIVE_DIR_BASE/date=$YESTERDAY_DATE/$BATCH_GLOB" 2>/dev/null
+  $HDFS_CMD dfs -fs $HDFS_URI -text "$ARCHIVE_DIR_BASE/date=$TODAY_DATE/$BATCH_GLOB" 2>/dev/null
+  $HDFS_CMD dfs -fs $HDFS_URI -text "$INCOMING_DIR/$BATCH_GLOB" 2>/dev/null
 } | python3 /app/train_model.py > $MODEL_LOCAL
 
 if [ -s "$MODEL_LOCAL" ]; then
@@ -42,6 +46,8 @@ if [ -s "$MODEL_LOCAL" ]; then
 fi
 
 # --- FASE 2: MAPREDUCE (SOLO SU INCOMING) ---
+# Il reducer fa anche da combiner: ogni map task invia allo shuffle un solo
+# stato parziale per (sensore, giorno) invece di una riga per evento.
 BATCH_OUTPUT_DIR="$INCREMENTAL_OUT/date=$TODAY_DATE/batch_$CURRENT_TIME"
 
 $HADOOP_CMD jar $HADOOP_HOME/share/hadoop/tools/lib/hadoop-streaming-*.jar \
@@ -50,8 +56,9 @@ $HADOOP_CMD jar $HADOOP_HOME/share/hadoop/tools/lib/hadoop-streaming-*.jar \
     -fs $HDFS_URI \
     -files /app/mapper.py,/app/reducer.py,$MODEL_LOCAL \
     -mapper "python3 /app/mapper.py" \
+    -combiner "python3 /app/reducer.py --combine" \
     -reducer "python3 /app/reducer.py" \
-    -input "$INCOMING_DIR/*.jsonl" \
+    -input "$INCOMING_DIR/$BATCH_GLOB" \
     -output "$BATCH_OUTPUT_DIR" > /dev/null 2>&1
 
 # --- VARIABILE PER TUTTI I RISULTATI DI OGGI ---
@@ -70,6 +77,20 @@ if $HDFS_CMD dfs -fs $HDFS_URI -test -e "$ALL_BATCHES_RESULTS"; then
     # Controlla se il file locale non è vuoto (-s)
     if [ -s /tmp/daily_unified.json ]; then
         $HDFS_CMD dfs -fs $HDFS_URI -put -f /tmp/daily_unified.json "$SUMMARY_OUTPUT_PATH/daily_stats.json"
+
+        # Un file per sensore (sensor=A1/daily_stats.json): la dashboard legge
+        # direttamente la riga che le serve. Un solo -put per tutte le cartelle.
+        rm -rf /tmp/daily_split && mkdir -p /tmp/daily_split
+        while IFS=$'\t' read -r key metrics; do
+            sid="${key%%-*}"
+            mkdir -p "/tmp/daily_split/sensor=$sid"
+            printf '%s\t%s\n' "$key" "$metrics" > "/tmp/daily_split/sensor=$sid/daily_stats.json"
+        done < /tmp/daily_unified.json
+        $HDFS_CMD dfs -fs $HDFS_URI -put -f /tmp/daily_split/* "$SUMMARY_OUTPUT_PATH/"
+
+        # Stesse metriche su Cassandra: la dashboard le legge con una lookup per chiave
+        python3 /app/publish_summary.py "$TODAY_DATE" < /tmp/daily_unified.json \
+            || log "⚠️ Pubblicazione su Cassandra fallita (resta il file su HDFS)."
         log "✅ Daily Stats generate."
     else
         log "⚠️ Daily Stats vuote (Errore Python o Input vuoto)."
@@ -94,7 +115,7 @@ fi
 DEST_ARCHIVE="$ARCHIVE_DIR_BASE/date=$TODAY_DATE"
 $HDFS_CMD dfs -fs $HDFS_URI -mkdir -p $DEST_ARCHIVE
 
-for file in $($HDFS_CMD dfs -fs $HDFS_URI -ls "$INCOMING_DIR/*.jsonl" | awk '{print $8}'); do
+for file in $($HDFS_CMD dfs -fs $HDFS_URI -ls "$INCOMING_DIR/$BATCH_GLOB" | awk '{print $8}'); do
     $HDFS_CMD dfs -fs $HDFS_URI -mv "$file" "$DEST_ARCHIVE/"
 done
 
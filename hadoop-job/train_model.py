@@ -4,9 +4,73 @@ import json
 import math
 from datetime import datetime, timedelta
 import statistics
+from collections import defaultdict
+
+# Parser JSON in C se disponibile sul nodo, altrimenti la libreria standard
+try:
+    from orjson import loads as _loads
+except ImportError:
+    from json import loads as _loads
+
+# Decoder strutturato (msgspec, opzionale): legge solo i tre campi usati,
+# senza costruire un dizionario per riga. defstruct invece di una classe
+# annotata, per restare compatibili con Python 3.5.
+try:
+    import msgspec
+    Row = msgspec.defstruct('Row', [('sensor_id', str), ('temp', float), ('timestamp', str)])
+    _row_decoder = msgspec.json.Decoder(Row)
+except ImportError:
+    _row_decoder = None
+
+# NumPy è opzionale: senza, le statistiche si calcolano in puro Python
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def fit_python(temps):
+    """Filtro IQR semplificato, poi media e deviazione standard dei dati rimasti."""
+    n = len(temps)
+    temps.sort()
+    q1 = temps[int(n * 0.25)]
+    q3 = temps[int(n * 0.75)]
+    iqr = q3 - q1
+
+    lower = q1 - (1.5 * iqr)
+    upper = q3 + (1.5 * iqr)
+
+    cleaned = [t for t in temps if lower <= t <= upper]
+
+    # Fallback se il filtro è troppo aggressivo
+    if len(cleaned) < 2: cleaned = temps
+
+    mean_val = statistics.mean(cleaned)
+    std_dev_val = statistics.stdev(cleaned) if len(cleaned) > 1 else 0.0
+    return mean_val, std_dev_val
+
+def fit_numpy(temps):
+    """
+    Come fit_python, su array NumPy: i quartili con np.partition (O(n),
+    nessun ordinamento completo), filtro con una maschera booleana.
+    """
+    n = len(temps)
+    a = np.fromiter(temps, dtype=np.float64, count=n)
+    q1_idx = int(n * 0.25)
+    q3_idx = int(n * 0.75)
+    q1, q3 = np.partition(a, [q1_idx, q3_idx])[[q1_idx, q3_idx]]
+    iqr = q3 - q1
+
+    cleaned = a[(a >= q1 - (1.5 * iqr)) & (a <= q3 + (1.5 * iqr))]
+
+    # Fallback se il filtro è troppo aggressivo
+    if len(cleaned) < 2: cleaned = a
+
+    mean_val = float(cleaned.mean())
+    std_dev_val = float(cleaned.std(ddof=1)) if len(cleaned) > 1 else 0.0
+    return mean_val, std_dev_val
 
 def main():
-    temps_by_sensor = {} 
+    temps_by_sensor = defaultdict(list)
     
     # --- MODIFICA 1: Finestra temporale più ampia (60 minuti) ---
     # Questo evita che piccoli ritardi nel batching facciano trovare 0 dati
@@ -18,16 +82,23 @@ def main():
     lines_read = 0
     valid_data_count = 0
 
-    for line in sys.stdin:
+    # Con msgspec le righe si leggono come bytes (nessuna decodifica UTF-8)
+    stream = sys.stdin.buffer if _row_decoder is not None else sys.stdin
+
+    for line in stream:
         lines_read += 1
         try:
-            line = line.strip()
-            if not line: continue
-            
-            data = json.loads(line)
-            sensor_id = data.get("sensor_id")
-            temp = data.get("temp")
-            timestamp_str = data.get("timestamp")
+            if not line.strip(): continue
+
+            if _row_decoder is not None:
+                # Campi mancanti o di tipo errato: ValidationError, riga ignorata
+                row = _row_decoder.decode(line)
+                sensor_id, temp, timestamp_str = row.sensor_id, row.temp, row.timestamp
+            else:
+                data = _loads(line)
+                sensor_id = data.get("sensor_id")
+                temp = data.get("temp")
+                timestamp_str = data.get("timestamp")
 
             if sensor_id and temp is not None and timestamp_str:
                 # Gestione robusta timestamp
@@ -41,8 +112,6 @@ def main():
                 
                 # Filtra solo dati recenti
                 if data_timestamp >= time_window_ago:
-                    if sensor_id not in temps_by_sensor:
-                        temps_by_sensor[sensor_id] = []
                     temps_by_sensor[sensor_id].append(float(temp))
                     valid_data_count += 1
 
@@ -63,33 +132,18 @@ def main():
         
         # Richiede almeno 3 punti dati per un modello minimo
         if n > 2: 
-            # --- FILTRO IQR SEMPLIFICATO ---
-            temps.sort()
-            q1_idx = int(n * 0.25)
-            q3_idx = int(n * 0.75)
-            q1 = temps[q1_idx]
-            q3 = temps[q3_idx]
-            iqr = q3 - q1
-            
-            lower = q1 - (1.5 * iqr)
-            upper = q3 + (1.5 * iqr)
-            
-            cleaned = [t for t in temps if lower <= t <= upper]
-            
-            # Fallback se il filtro è troppo aggressivo
-            if len(cleaned) < 2: cleaned = temps
-
-            if len(cleaned) > 0:
-                mean_val = statistics.mean(cleaned)
-                std_dev_val = statistics.stdev(cleaned) if len(cleaned) > 1 else 0.0
-                
-                # Evita deviazione standard zero
-                if std_dev_val == 0: std_dev_val = mean_val * 0.001
+            if np is not None:
+                mean_val, std_dev_val = fit_numpy(temps)
+            else:
+                mean_val, std_dev_val = fit_python(temps)
+
+            # Evita deviazione standard zero
+            if std_dev_val == 0: std_dev_val = mean_val * 0.001
 
-                model[sensor_id] = {
-                    "mean": round(mean_val, 2),
-                    "std_dev": round(std_dev_val, 4)
-                }
+            model[sensor_id] = {
+                "mean": round(mean_val, 2),
+                "std_dev": round(std_dev_val, 4)
+            }
 
     # Stampa il modello finale
     print(json.dumps(model, indent=2))
@@ -6,7 +6,23 @@ Calcola le statistiche giornaliere aggregate, inclusa la Media Pesata (Avg Price
 import sys
 import json
 
+# Schema fisso del JSON giornaliero (stesso ordine dei campi di sempre)
+DAILY_JSON = (
+    '{{"open": {:.2f}, "close": {:.2f}, "min": {:.2f}, "max": {:.2f}, "mean": {:.2f}, '
+    '"count": {}, "discarded_count": {}, "daily_change": {:.2f}, "daily_change_pct": {:.2f}, '
+    '"volatility": {:.2f}, "range_pct": {:.2f}, "discarded_pct": {:.2f}}}'
+)
+
+PRICE_FIELDS = ('open', 'close', 'min', 'max', 'volatility')
+
 def update_daily_stats(daily, batch):
+    # Batch senza metriche di prezzo (tutto scartato, o valori non finiti emessi
+    # come null dal reducer): contano solo i conteggi
+    if any(batch.get(f) is None for f in PRICE_FIELDS):
+        daily['discarded_count'] += batch['discarded_count']
+        daily['total_count'] += batch.get('total_count', 0)
+        return daily
+
     # Aggiorna Min/Max Assoluti
     if daily['min'] is None or batch['min'] < daily['min']:
         daily['min'] = batch['min']
@@ -84,22 +100,25 @@ def main():
         if stats['count'] > 0:
             mean_val = stats['weighted_sum'] / stats['count']
 
-        output = {
-            "open": round(stats['open'], 2),
-            "close": round(stats['close'], 2),
-            "min": round(stats['min'], 2),
-            "max": round(stats['max'], 2),
-            "mean": round(mean_val, 2), # Nuovo campo Mean
-            "count": stats['count'],
-            "discarded_count": stats['discarded_count'],
-            "daily_change": round(change, 2),
-            "daily_change_pct": round(change_pct, 2),
-            "volatility": round(stats['volatility'], 2),
-            "range_pct": round(range_pct, 2),
-            "discarded_pct": round(disc_pct, 2)
-        }
-        
-        print("{}-DAILY\t{}".format(sensor_id, json.dumps(output)))
+        if stats['open'] is None:
+            # Nessun batch con prezzi validi: solo i conteggi
+            output = json.dumps({
+                "open": None, "close": None, "min": None, "max": None, "mean": None,
+                "count": stats['count'], "discarded_count": stats['discarded_count'],
+                "daily_change": None, "daily_change_pct": None, "volatility": None,
+                "range_pct": None, "discarded_pct": round(disc_pct, 2)
+            })
+            print("{}-DAILY\t{}".format(sensor_id, output))
+            continue
+
+        # Arrotondamento a 2 decimali direttamente nella formattazione
+        output = DAILY_JSON.format(
+            stats['open'], stats['close'], stats['min'], stats['max'],
+            mean_val, stats['count'], stats['discarded_count'],
+            change, change_pct, stats['volatility'], range_pct, disc_pct
+        )
+
+        print("{}-DAILY\t{}".format(sensor_id, output))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
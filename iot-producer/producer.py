@@ -1,12 +1,16 @@
 import os
 import time
 import json
+import queue
+import orjson
 import logging
 import websocket 
 import threading
+import itertools
 from datetime import datetime
 from cassandra.cluster import Cluster
 from hdfs import InsecureClient
+from hdfs.util import HdfsError
 
 # --- Impostazioni Logging ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -29,6 +33,28 @@ SENSOR_MAP = {
     "C1": "solusdt" 
 }
 INVERSE_SENSOR_MAP = {v: k for k, v in SENSOR_MAP.items()}
+
+# Marcatore dei frame di trade: gli altri frame (es. risposta alla SUBSCRIBE)
+# vengono scartati senza parsing JSON
+TRADE_MARKER = '"e":"trade"'
+
+# Decoder strutturato (msgspec, opzionale): legge solo i campi e/s/p/E
+# senza costruire i dizionari dell'intero messaggio
+try:
+    import msgspec
+
+    class BinanceTrade(msgspec.Struct):
+        e: str
+        s: str
+        p: str
+        E: int
+
+    class BinanceTradeFrame(msgspec.Struct):
+        data: BinanceTrade
+
+    _trade_decoder = msgspec.json.Decoder(BinanceTradeFrame)
+except ImportError:
+    _trade_decoder = None
 # --- Fine ---
 
 # Variabili globali per le connessioni
@@ -46,14 +72,39 @@ LAST_MODEL_CHECK_TIME = 0
 MODEL_CHECK_INTERVAL = 60 # Controlla HDFS per un nuovo modello ogni 60 secondi
 
 # Contatore per gli scarti (in memoria)
-discard_counter_memory = 0
-discard_lock = threading.Lock() # Lock per il contatore
+# itertools.count: next() è atomico sotto il GIL, nessun lock per incremento.
+# Il valore si legge solo alla rotazione (next() restituisce gli scarti contati).
+discard_counter_memory = itertools.count()
 HDFS_DISCARD_STATS_PATH = '/models/discard_stats.json'
 HDFS_ROTATE_TRIGGER_PATH = '/models/rotate_trigger'
 
 # Timeout per operazioni HDFS
 HDFS_TIMEOUT = 15  # secondi
 
+# Buffer di scrittura HDFS: i trade vengono accumulati in memoria e scritti
+# con un solo append per file ogni HDFS_FLUSH_INTERVAL secondi (o prima,
+# se il buffer supera HDFS_FLUSH_BYTES)
+HDFS_FLUSH_INTERVAL = 5  # secondi
+HDFS_FLUSH_BYTES = 256 * 1024
+_hdfs_buffers = {}  # path file HDFS -> bytearray
+_hdfs_buffered_bytes = 0
+_hdfs_lock = threading.Lock()
+_hdfs_flush_event = threading.Event()
+# Opzioni orjson per le righe JSONL: il '\n' finale lo aggiunge il serializzatore.
+HDFS_JSON_OPTS = orjson.OPT_APPEND_NEWLINE
+# Partizioni e file già creati su HDFS: in regime nessuna chiamata status()
+_known_dirs = set()
+_known_files = set()
+
+# Coda tra il callback del WebSocket e i worker che scrivono su HDFS/Cassandra
+WORK_QUEUE_SIZE = 10000
+STORAGE_WORKERS = 2
+work_q = queue.Queue(maxsize=WORK_QUEUE_SIZE)
+
+# Giorno corrente (giorni dall'epoch) e sua stringa 'YYYY-MM-DD'
+_cached_day = None
+_cached_day_str = None
+
 def setup_connections():
     """Inizializza o re-inizializza le connessioni globali."""
     global cassandra_session, cassandra_cluster, hdfs_client, cassandra_query
@@ -67,8 +118,10 @@ def setup_connections():
     # Connettiti a Cassandra
     while True:
         try:
-            cluster = Cluster([CASSANDRA_HOST], port=9042)
+            # Protocollo v5 (come la dashboard) con compressione LZ4 dei frame
+            cluster = Cluster([CASSANDRA_HOST], port=9042, protocol_version=5, compression=True)
             session = cluster.connect(CASSANDRA_KEYSPACE)
+            session.default_timeout = 10
             log.info("Connesso a Cassandra!")
             cassandra_cluster = cluster
             cassandra_session = session
@@ -184,10 +237,9 @@ def rotate_discard_counters():
     
     log.info("--- Rilevato trigger di rotazione contatori ---")
     
-    current_job_discards = 0
-    with discard_lock:
-        current_job_discards = discard_counter_memory
-        discard_counter_memory = 0 
+    # Scambia il contatore con uno nuovo, poi legge quello vecchio
+    counter, discard_counter_memory = discard_counter_memory, itertools.count()
+    current_job_discards = next(counter)
     
     old_stats = {"previous": 0, "current": 0}
     try:
@@ -211,8 +263,7 @@ def rotate_discard_counters():
         log.info(f"Statistiche scarti aggiornate su HDFS: {new_stats}")
     except Exception as e:
         log.error(f"Impossibile scrivere il nuovo file di stato degli scarti! {e}")
-        with discard_lock:
-            discard_counter_memory += current_job_discards
+        discard_counter_memory = itertools.count(next(discard_counter_memory) + current_job_discards)
 
     try:
         hdfs_client.delete(HDFS_ROTATE_TRIGGER_PATH)
@@ -221,31 +272,165 @@ def rotate_discard_counters():
         log.error(f"Impossibile rimuovere il file trigger! {e}")
 
 
+def log_cassandra_error(exc):
+    """Errback delle scritture asincrone su Cassandra."""
+    log.error(f"Errore scrittura Cassandra: {exc}")
+
+def buffer_hdfs(path, line):
+    """Accoda una riga (bytes) al buffer del file HDFS; sveglia il flusher se il buffer è pieno."""
+    global _hdfs_buffered_bytes
+    with _hdfs_lock:
+        buf = _hdfs_buffers.get(path)
+        if buf is None:
+            buf = _hdfs_buffers[path] = bytearray()
+        buf += line
+        _hdfs_buffered_bytes += len(line)
+        full = _hdfs_buffered_bytes >= HDFS_FLUSH_BYTES
+    if full:
+        _hdfs_flush_event.set()
+
+def ensure_hdfs_file(path):
+    """
+    Crea (una volta per giorno) la partizione e il file vuoto su cui fare append.
+    Niente status(): makedirs è idempotente e la creazione di un file già
+    esistente (es. dopo un riavvio) fallisce senza toccarne il contenuto.
+    """
+    if path in _known_files:
+        return
+
+    partition_dir = path.rsplit('/', 1)[0]
+    if partition_dir not in _known_dirs:
+        hdfs_client.makedirs(partition_dir)
+        _known_dirs.add(partition_dir)
+
+    try:
+        hdfs_client.write(path, data=b'', overwrite=False)
+        log.info(f"Creazione file di log: {path}")
+    except HdfsError as e:
+        # Solo 'file già presente' è atteso: ogni altro errore (safe mode, permessi,
+        # quota) risale al flush e il file non viene segnato come noto
+        if getattr(e, 'exception', None) != 'FileAlreadyExistsException':
+            raise
+    _known_files.add(path)
+
+def flush_hdfs_buffers():
+    """Scrive su HDFS il contenuto dei buffer: un solo append per file."""
+    global _hdfs_buffers, _hdfs_buffered_bytes
+    with _hdfs_lock:
+        pending = _hdfs_buffers
+        _hdfs_buffers = {}
+        _hdfs_buffered_bytes = 0
+
+    for path, data in pending.items():
+        try:
+            ensure_hdfs_file(path)
+            hdfs_client.write(path, data=bytes(data), append=True)
+        except Exception as e:
+            log.error(f"Errore scrittura HDFS ({path}): {e}")
+            # Rimette i dati in testa al buffer: verranno riprovati al prossimo flush
+            with _hdfs_lock:
+                _hdfs_buffers[path] = data + _hdfs_buffers.get(path, bytearray())
+                _hdfs_buffered_bytes += len(data)
+
+def hdfs_flusher():
+    """Thread che svuota i buffer HDFS ogni HDFS_FLUSH_INTERVAL secondi o a buffer pieno."""
+    log.info("💾 HDFS Flusher avviato")
+    while True:
+        _hdfs_flush_event.wait(HDFS_FLUSH_INTERVAL)
+        _hdfs_flush_event.clear()
+        if hdfs_client:
+            flush_hdfs_buffers()
+
+def parse_trade(message):
+    """Estrae (simbolo, prezzo, timestamp_ms) da un frame di trade, None se non è un trade."""
+    if _trade_decoder is not None:
+        try:
+            trade = _trade_decoder.decode(message).data
+        except (msgspec.ValidationError, msgspec.DecodeError):
+            return None
+        if trade.e != 'trade':
+            return None
+        return trade.s, trade.p, trade.E
+
+    wrapper = orjson.loads(message)
+    if 'data' not in wrapper:
+        return None
+
+    trade_data = wrapper['data']
+
+    if trade_data.get('e') != 'trade': # Controlla che sia un trade
+        return None
+    return trade_data['s'], trade_data['p'], trade_data['E']
+
+def format_timestamp_ms(timestamp_ms):
+    """
+    Converte i millisecondi UTC in (data 'YYYY-MM-DD', 'YYYY-MM-DDTHH:MM:SS[.ffffff]')
+    con sola aritmetica intera: la data viene formattata una volta per giorno
+    e il risultato coincide con datetime.utcfromtimestamp(...).isoformat().
+    """
+    global _cached_day, _cached_day_str
+    day, ms_of_day = divmod(timestamp_ms, 86400000)
+    if day != _cached_day:
+        _cached_day_str = datetime.utcfromtimestamp(day * 86400).strftime('%Y-%m-%d')
+        _cached_day = day
+    seconds, ms = divmod(ms_of_day, 1000)
+    minutes, sec = divmod(seconds, 60)
+    hour, minute = divmod(minutes, 60)
+    iso = '%sT%02d:%02d:%02d' % (_cached_day_str, hour, minute, sec)
+    if ms:
+        iso += '.%03d000' % ms
+    return _cached_day_str, iso
+
+def store_trade(data, current_date_str, timestamp_ms, is_clean):
+    """Scrive un trade su HDFS (sempre, via buffer) e su Cassandra (solo se pulito)."""
+    # 2. Invio a HDFS (SEMPRE): accodato nel buffer, lo scrive hdfs_flusher
+    try:
+        HDFS_FILE = f"{HDFS_BASE_DIR}/date={current_date_str}/crypto_trades.jsonl"
+        buffer_hdfs(HDFS_FILE, orjson.dumps(data, option=HDFS_JSON_OPTS))
+    except Exception as e:
+        log.error(f"Errore scrittura HDFS: {e}")
+
+    # 3. Invio a Cassandra (SOLO SE PULITO)
+    if is_clean:
+        try:
+            # Asincrono: il worker non attende il round-trip.
+            # Il driver accetta il timestamp come millisecondi interi.
+            future = cassandra_session.execute_async(
+                cassandra_query, 
+                (data['sensor_id'], timestamp_ms, data['temp'])
+            )
+            future.add_errback(log_cassandra_error)
+        except Exception as e:
+            log.error(f"Errore scrittura Cassandra: {e}")
+
+def storage_worker():
+    """Thread che consuma la coda dei trade ed esegue le scritture."""
+    while True:
+        store_trade(*work_q.get())
+
 def on_message(ws, message):
     """
     Callback eseguito per OGNI messaggio ricevuto dal WebSocket.
     Modificato per gestire lo stream @trade.
     """
-    global cassandra_query, hdfs_client, last_data_received_time, discard_counter_memory
+    global last_data_received_time
     try:
-        wrapper = json.loads(message)
-        if 'data' not in wrapper:
+        if TRADE_MARKER not in message:
             return
-        
-        trade_data = wrapper['data']
-        
-        if trade_data.get('e') != 'trade': # Controlla che sia un trade
+
+        trade = parse_trade(message)
+        if trade is None:
             return
 
-        symbol = trade_data['s'].lower() 
+        symbol = trade[0].lower() 
         sensor_id = INVERSE_SENSOR_MAP.get(symbol, "UNKNOWN")
         
         if sensor_id == "UNKNOWN":
             return 
         
-        price = float(trade_data['p']) 
-        timestamp_ms = trade_data['E'] 
-        timestamp = datetime.utcfromtimestamp(timestamp_ms / 1000.0)
+        price = float(trade[1]) 
+        timestamp_ms = trade[2] 
+        current_date_str, timestamp = format_timestamp_ms(timestamp_ms)
 
         data = {
             "sensor_id": sensor_id,
@@ -270,54 +455,17 @@ def on_message(ws, message):
             else:
                 log.warning(f"DATO FILTRATO (Anomalia): {sensor_id} | Prezzo: {price}")
                 is_clean = False
-                with discard_lock:
-                    discard_counter_memory += 1
+                next(discard_counter_memory)
         else:
             is_clean = False
             log.info("Dato non inviato a Cassandra (in attesa del modello).")
 
-        # 2. Invio a HDFS (SEMPRE)
+        # 2-3. Scritture su HDFS e Cassandra delegate ai worker: il thread
+        # del WebSocket non esegue mai I/O
         try:
-            current_date_str = data['timestamp'].strftime('%Y-%m-%d')
-            HDFS_PARTITION_DIR = f"{HDFS_BASE_DIR}/date={current_date_str}"
-            HDFS_FILE = f"{HDFS_PARTITION_DIR}/crypto_trades.jsonl"
-
-            try:
-                if not hdfs_client.status(HDFS_PARTITION_DIR, strict=False):
-                    hdfs_client.makedirs(HDFS_PARTITION_DIR)
-            except Exception as e:
-                log.debug(f"Errore check dir HDFS: {e}")
-
-            try:
-                if not hdfs_client.status(HDFS_FILE, strict=False):
-                    log.info(f"Creazione file di log: {HDFS_FILE}")
-                    with hdfs_client.write(HDFS_FILE, encoding='utf-8', append=False) as writer:
-                        writer.write("")
-            except Exception as e:
-                log.debug(f"Errore create file HDFS: {e}")
-
-            data_hdfs = data.copy()
-            data_hdfs['timestamp'] = data_hdfs['timestamp'].isoformat()
-            json_data = json.dumps(data_hdfs) + '\n'
-            
-            try:
-                with hdfs_client.write(HDFS_FILE, encoding='utf-8', append=True) as writer:
-                    writer.write(json_data)
-            except Exception as e:
-                log.error(f"Errore scrittura HDFS: {e}")
-                
-        except Exception as e:
-            log.error(f"Errore scrittura HDFS: {e}")
-
-        # 3. Invio a Cassandra (SOLO SE PULITO)
-        if is_clean:
-            try:
-                cassandra_session.execute(
-                    cassandra_query, 
-                    (data['sensor_id'], data['timestamp'], data['temp'])
-                )
-            except Exception as e:
-                log.error(f"Errore scrittura Cassandra: {e}")
+            work_q.put_nowait((data, current_date_str, timestamp_ms, is_clean))
+        except queue.Full:
+            log.warning(f"Coda di scrittura piena: trade scartato ({sensor_id})")
         
     except Exception as e:
         log.error(f"Errore nell'elaborazione del messaggio: {e} - Messaggio: {message}")
@@ -382,6 +530,13 @@ def main():
     watcher_thread = threading.Thread(target=model_watcher, daemon=True)
     watcher_thread.start()
     log.info("✅ Model Watcher thread avviato")
+
+    # Avvia il thread che scrive su HDFS i trade accumulati
+    threading.Thread(target=hdfs_flusher, daemon=True).start()
+
+    # Avvia i worker di scrittura (HDFS + Cassandra)
+    for _ in range(STORAGE_WORKERS):
+        threading.Thread(target=storage_worker, daemon=True).start()
     
     # Inizializza il file di stato scarti se non esiste
     if hdfs_client and not hdfs_client.status(HDFS_DISCARD_STATS_PATH, strict=False):
@@ -445,6 +600,8 @@ def main():
         log.info("Spegnimento producer (ricevuto KeyboardInterrupt)...")
     finally:
         log.info("Chiusura connessioni finali...")
+        if hdfs_client:
+            flush_hdfs_buffers()
         if cassandra_session:
             cassandra_session.shutdown()
         if cassandra_cluster:
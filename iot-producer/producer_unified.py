@@ -1,26 +1,37 @@
 import os
+import math
 import time
 import json
+import gzip
+import orjson
 import logging
-import requests
+import asyncio
+import httpx
 import threading
 import queue
+import atexit
+import signal
+import sys
 import websocket 
-import urllib3
-from collections import defaultdict
+from collections import defaultdict, deque
 from datetime import datetime
+from cassandra import ConsistencyLevel
 from cassandra.cluster import Cluster
 from cassandra.policies import DCAwareRoundRobinPolicy 
+from cassandra.query import BatchStatement, BatchType
 from hdfs import InsecureClient
+from hdfs.util import HdfsError
 
 # --- Configurazione Logging ---
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - PRODUCER - %(message)s')
+# Default WARNING: i messaggi INFO (riepiloghi, stato connessioni) si attivano con LOG_LEVEL=INFO
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'WARNING').upper()
+logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s - PRODUCER - %(message)s')
 log = logging.getLogger(__name__)
 
 # Silenziamento warning librerie
 logging.getLogger("hdfs").setLevel(logging.WARNING)
-logging.getLogger("urllib3").setLevel(logging.WARNING)
-logging.getLogger("requests").setLevel(logging.WARNING)
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logging.getLogger("httpcore").setLevel(logging.WARNING)
 logging.getLogger("websocket").setLevel(logging.WARNING)
 
 # --- Env ---
@@ -36,45 +47,112 @@ HDFS_INCOMING_DIR = '/iot-data/incoming' # Buffer per i nuovi dati
 
 # --- Configurazione Timing ---
 AGGREGATION_WINDOW = 1.0  
+CASSANDRA_WRITE_TIMEOUT = 2  # secondi
 HDFS_BATCH_SIZE = 500      # Aumentato per ridurre piccoli file
 HDFS_FLUSH_INTERVAL = 60   # Aumentato a 60s per ridurre carico su NameNode
-STATS_FLUSH_INTERVAL = 10 
+QUEUE_DRAIN_SIZE = 256     # elementi prelevati da data_queue per iterazione
+MODEL_REFRESH_INTERVAL = 60
+STATS_FLUSH_INTERVAL = 15 # come la cache della dashboard; si scrive solo se il totale è cambiato (e all'uscita)
+
+# Opzioni orjson per le righe dei batch. Niente OPT_NAIVE_UTC: il suffisso
+# '+00:00' romperebbe il formato del timestamp letto da train_model.py
+HDFS_JSON_OPTS = orjson.OPT_APPEND_NEWLINE
+# Batch compressi con gzip: Hadoop Streaming e 'hdfs dfs -text' li decomprimono
+# in base all'estensione, mapper e training restano invariati
+HDFS_BATCH_EXT = '.jsonl.gz'
+# Il batch si scrive con un nome temporaneo (nascosto per Hadoop, fuori dal glob
+# *.jsonl* di run_job.sh) e poi si rinomina: il job non vede mai un .gz troncato
+HDFS_TMP_PREFIX = '_'
+HDFS_TMP_EXT = '.tmp'
+HDFS_GZIP_LEVEL = 6
 
-aggregation_buffer = defaultdict(list)
-buffer_lock = threading.Lock()
 
 # --- API Esterne ---
 BINANCE_WS_URL = "wss://stream.binance.com:9443/stream"
 COINBASE_API_URL = "https://api.coinbase.com/v2/prices/{}/spot"
 COINGECKO_API_URL = "https://api.coingecko.com/api/v3/simple/price"
 
+# Decoder strutturato (msgspec, opzionale): legge solo i campi e/s/p/E/t
+# del trade senza costruire i dizionari dell'intero messaggio
+try:
+    import msgspec
+
+    class BinanceTrade(msgspec.Struct):
+        e: str
+        s: str
+        p: str
+        E: int
+        t: int
+
+    class BinanceTradeFrame(msgspec.Struct):
+        data: BinanceTrade
+
+    _trade_decoder = msgspec.json.Decoder(BinanceTradeFrame)
+except ImportError:
+    _trade_decoder = None
+
+# Sensori come interi (indici in SID_LABELS) lungo tutto il percorso interno:
+# l'etichetta testuale serve solo per HDFS, Cassandra, modello e log
+SID_LABELS = ("A1", "B1", "C1")
+A1, B1, C1 = range(len(SID_LABELS))
+
 UNIFIED_MAP = {
-    "btcusdt": "A1", "ethusdt": "B1", "solusdt": "C1",
-    "BTC-USD": "A1", "ETH-USD": "B1", "SOL-USD": "C1",
-    "bitcoin": "A1", "ethereum": "B1", "solana": "C1"
+    "btcusdt": A1, "ethusdt": B1, "solusdt": C1,
+    "BTC-USD": A1, "ETH-USD": B1, "SOL-USD": C1,
+    "bitcoin": A1, "ethereum": B1, "solana": C1
 }
 
+# Buffer della finestra di aggregazione: una lista per sensore, indicizzata per sid.
+# L'aggregatore scambia il buffer intero a ogni finestra e consuma quello vecchio.
+# Il lock copre solo lo scambio e gli extend di un blocco (una volta per blocco,
+# non per tick): nessun tick può finire in un buffer già consumato.
+def new_aggregation_buffer():
+    return [[] for _ in SID_LABELS]
+
+aggregation_buffer = new_aggregation_buffer()
+aggregation_lock = threading.Lock()
+
 # --- Globals ---
 data_queue = queue.Queue(maxsize=10000) 
+hdfs_write_queue = queue.Queue() # batch (liste di righe JSON in bytes) in attesa di scrittura su HDFS
 cassandra_session = None
 hdfs_client = None
 cassandra_query = None
+cassandra_minute_query = None
+cassandra_minute_select = None
 
-filtering_model = None
-model_lock = threading.Lock()
+# Limiti 3-sigma per sensore (lista indicizzata per sid), ricalcolati a ogni aggiornamento
+# del modello e pubblicati con un'unica riassegnazione: la lettura non richiede lock
+filtering_model_bounds = None
 HDFS_MODEL_PATH = '/models/model.json'
+model_mtime = None # modificationTime dell'ultimo modello letto
 HDFS_DISCARD_STATS_PATH = '/models/discard_stats.json'
-discard_counter = 0
-discard_lock = threading.Lock()
+# Totale scarti cumulativo: il valore persistito (discard_base) si legge da HDFS
+# una sola volta, gli scarti dall'avvio (discard_total) restano in memoria
+# (unico scrittore: process_aggregates, niente lock). Finché la lettura non
+# riesce (_discard_loaded) il file non viene mai sovrascritto.
+discard_total = 0
+discard_base = 0
+discard_total_saved = None
+_discard_loaded = False
+
+# Ultimi file batch scritti in incoming (dal più vecchio): tenuti in memoria,
+# così la pulizia non richiede un listing della cartella a ogni scrittura
+MAX_INCOMING_BATCHES = 3
+recent_batches = deque(maxlen=MAX_INCOMING_BATCHES)
 
 def setup_connections():
-    global cassandra_session, hdfs_client, cassandra_query
+    global cassandra_session, hdfs_client, cassandra_query, cassandra_minute_query, cassandra_minute_select
     # 1. Cassandra
     while True:
         try:
             cluster = Cluster([CASSANDRA_HOST], port=9042, load_balancing_policy=DCAwareRoundRobinPolicy(local_dc='datacenter1'))
-            cassandra_session = cluster.connect() 
-            cassandra_query = cassandra_session.prepare(f"INSERT INTO {CASSANDRA_KEYSPACE}.sensor_data (sensor_id, timestamp, temp) VALUES (?, ?, ?)")
+            cassandra_session = cluster.connect(CASSANDRA_KEYSPACE)
+            # Un solo replica ack per scrittura (dato di speed layer, sovrascritto di continuo)
+            cassandra_session.default_consistency_level = ConsistencyLevel.ONE
+            cassandra_query = cassandra_session.prepare("INSERT INTO sensor_data (sensor_id, timestamp, temp) VALUES (?, ?, ?)")
+            cassandra_minute_query = cassandra_session.prepare("INSERT INTO sensor_data_minute (sensor_id, minute_ts, temp_sum, temp_count) VALUES (?, ?, ?, ?)")
+            cassandra_minute_select = cassandra_session.prepare("SELECT temp_sum, temp_count FROM sensor_data_minute WHERE sensor_id = ? AND minute_ts = ?")
             log.info("✅ Cassandra Connesso")
             break
         except Exception: time.sleep(5)
@@ -83,263 +161,442 @@ def setup_connections():
     while True:
         try:
             hdfs_client = InsecureClient(f"http://{HDFS_HOST}:{HDFS_PORT}", user=HDFS_USER, timeout=120)
-            # Crea cartelle struttura
+            # Crea cartelle struttura (MKDIRS è idempotente: nessun controllo preventivo)
             for d in [HDFS_BASE_DIR, HDFS_INCOMING_DIR, '/models']:
-                if not hdfs_client.status(d, strict=False): hdfs_client.makedirs(d)
+                hdfs_client.makedirs(d)
             log.info("✅ HDFS Connesso")
             break
         except Exception: time.sleep(5)
+    seed_recent_batches()
+
+def hdfs_error_is(e, name):
+    """Nome dell'eccezione remota WebHDFS (es. 'FileNotFoundException')."""
+    return getattr(e, 'exception', None) == name
 
 def init_discard_stats():
-    if not hdfs_client: return
+    """
+    Lettura del totale persistito; riprovata dal flush periodico finché non riesce.
+    Solo 'file non trovato' conta come totale zero: ogni altro errore lascia il
+    totale non caricato, così il flush non sovrascrive il valore su HDFS.
+    """
+    global discard_base, discard_total_saved, _discard_loaded
+    if not hdfs_client or _discard_loaded: return
     try:
-        if not hdfs_client.status(HDFS_DISCARD_STATS_PATH, strict=False):
-            with hdfs_client.write(HDFS_DISCARD_STATS_PATH, encoding='utf-8', overwrite=True) as w:
+        # Lettura diretta senza status()
+        try:
+            with hdfs_client.read(HDFS_DISCARD_STATS_PATH, encoding='utf-8') as r:
+                content = r.read()
+        except HdfsError as e:
+            if not hdfs_error_is(e, 'FileNotFoundException'): raise
+            # overwrite=False: non sovrascrive un file creato nel frattempo
+            # (FileAlreadyExistsException: verrà letto al prossimo tentativo)
+            with hdfs_client.write(HDFS_DISCARD_STATS_PATH, encoding='utf-8', overwrite=False) as w:
                 json.dump({"total": 0}, w)
-    except Exception: pass
+            content = None
+        discard_base = int(json.loads(content).get("total", 0)) if content else 0
+        discard_total_saved = discard_base
+        _discard_loaded = True
+    except Exception as e:
+        log.error(f"Lettura stats scarti non riuscita (nuovo tentativo al prossimo flush): {e}")
 
 def flush_discard_stats():
-    global discard_counter
+    """Sovrascrive il totale su HDFS (nessuna lettura); salta se non è cambiato o non ancora caricato."""
+    global discard_total_saved
     if not hdfs_client: return
-    local_count = 0
-    with discard_lock:
-        if discard_counter == 0: return 
-        local_count = discard_counter
-    
+    if not _discard_loaded:
+        init_discard_stats()
+        if not _discard_loaded: return
+    total = discard_base + discard_total
+    if total == discard_total_saved: return
     try:
-        current_total = 0
-        read_success = False
-        if hdfs_client.status(HDFS_DISCARD_STATS_PATH, strict=False):
-            try:
-                with hdfs_client.read(HDFS_DISCARD_STATS_PATH, encoding='utf-8') as r:
-                    content = r.read()
-                    if content:
-                        data = json.loads(content)
-                        current_total = int(data.get("total", 0))
-                        read_success = True
-            except Exception: pass
-        else:
-            read_success = True
-
-        if read_success:
-            new_total = current_total + local_count
-            with hdfs_client.write(HDFS_DISCARD_STATS_PATH, encoding='utf-8', overwrite=True) as w:
-                json.dump({"total": new_total}, w)
-            with discard_lock:
-                discard_counter -= local_count
+        with hdfs_client.write(HDFS_DISCARD_STATS_PATH, encoding='utf-8', overwrite=True) as w:
+            json.dump({"total": total}, w)
+        discard_total_saved = total
     except Exception as e:
         log.error(f"Errore salvataggio stats: {e}")
 
-def cleanup_old_batches():
+def seed_recent_batches():
     """
-    Mantiene solo gli ultimi 3 file batch nella cartella incoming.
+    Un solo listing all'avvio: registra gli ultimi batch presenti in incoming
+    e cancella quelli in eccesso e i temporanei lasciati da un'uscita a metà scrittura.
     """
-    if not hdfs_client: return
     try:
         files = hdfs_client.list(HDFS_INCOMING_DIR)
-        # Filtra solo i file batch
-        batch_files = [f for f in files if f.startswith("batch_") and f.endswith(".jsonl")]
-        
-        # Se ce ne sono più di 3, cancella i più vecchi
-        if len(batch_files) > 3:
-            # Ordina per nome (che contiene il timestamp)
-            batch_files.sort()
-            
-            # Identifica quelli da cancellare (tutti tranne gli ultimi 3)
-            files_to_delete = batch_files[:-3]
-            
-            for f in files_to_delete:
-                try:
-                    hdfs_client.delete(f"{HDFS_INCOMING_DIR}/{f}")
-                    log.info(f"🗑️ Eliminato batch vecchio: {f}")
-                except Exception as e:
-                    log.warning(f"Impossibile eliminare {f}: {e}")
+        for f in files:
+            if f.startswith(HDFS_TMP_PREFIX + "batch_") and f.endswith(HDFS_TMP_EXT):
+                delete_batch(f)
+        # Filtra solo i file batch, ordinati per nome (che contiene il timestamp)
+        batch_files = sorted(f for f in files if f.startswith("batch_") and f.endswith((".jsonl", HDFS_BATCH_EXT)))
+        for f in batch_files[:-MAX_INCOMING_BATCHES]:
+            delete_batch(f)
+        recent_batches.extend(batch_files[-MAX_INCOMING_BATCHES:])
     except Exception as e:
         log.error(f"Errore cleanup batch: {e}")
 
+def delete_batch(filename):
+    try:
+        # Nessun errore se il job l'ha già archiviato (delete restituisce False)
+        if hdfs_client.delete(f"{HDFS_INCOMING_DIR}/{filename}"):
+            log.info(f"🗑️ Eliminato batch vecchio: {filename}")
+    except Exception as e:
+        log.warning(f"Impossibile eliminare {filename}: {e}")
+
+def register_batch(filename):
+    """Mantiene solo gli ultimi 3 file batch nella cartella incoming: cancella quello uscito dalla coda."""
+    evicted = recent_batches[0] if len(recent_batches) == MAX_INCOMING_BATCHES else None
+    recent_batches.append(filename)
+    if evicted:
+        delete_batch(evicted)
+
 def update_model():
-    global filtering_model
-    import tempfile
+    """
+    Rilegge il modello in memoria con il client esistente, solo se su HDFS è
+    cambiato: un GetFileInfo per controllo, OPEN+read solo dopo un nuovo training.
+    """
+    global filtering_model_bounds, model_mtime
+    if not hdfs_client: return
     try:
-        fast_client = InsecureClient(f"http://{HDFS_HOST}:{HDFS_PORT}", user=HDFS_USER, timeout=15)
-        if not fast_client.status(HDFS_MODEL_PATH, strict=False): return 
-        
-        with tempfile.NamedTemporaryFile(delete=False) as tmp:
-            local_path = tmp.name
+        st = hdfs_client.status(HDFS_MODEL_PATH, strict=False)
+        if not st or st['modificationTime'] == model_mtime: return
+        with hdfs_client.read(HDFS_MODEL_PATH) as r:
+            c = r.read()
+        if c and c.strip() != b'{}':
+            model = orjson.loads(c)
+            filtering_model_bounds = model_bounds(model)
+            log.info(f"🔄 Modello Aggiornato: {list(model.keys())}")
+        # Solo dopo un caricamento riuscito: un modello malformato viene riletto al giro successivo
+        model_mtime = st['modificationTime']
+    except Exception as e:
+        log.error(f"Errore aggiornamento modello: {e}")
+
+def model_bounds(model):
+    """(min, max) accettati per sid, None se il sensore non è nel modello. Tolleranza ampia (3 sigma); std_dev 0 accetta tutto."""
+    bounds = [None] * len(SID_LABELS)
+    for sid, label in enumerate(SID_LABELS):
+        params = model.get(label)
+        if params is None: continue
+        m = params['mean']
+        s = params['std_dev']
+        bounds[sid] = (-math.inf, math.inf) if s == 0 else (m - 3*s, m + 3*s)
+    return bounds
+
+def enqueue(item):
+    """
+    Inserimento non bloccante: a coda piena si scarta il tick più vecchio,
+    così i feeder (callback websocket compresa) non restano mai fermi.
+    """
+    try:
+        data_queue.put_nowait(item)
+    except queue.Full:
         try:
-            fast_client.download(HDFS_MODEL_PATH, local_path, overwrite=True)
-            with open(local_path, 'r') as f:
-                c = f.read()
-                if c and c.strip() != '{}':
-                    with model_lock: filtering_model = json.loads(c)
-                    log.info(f"🔄 Modello Aggiornato: {list(filtering_model.keys())}")
-        finally:
-            if os.path.exists(local_path): os.remove(local_path)
-    except Exception: pass
-
-def is_clean(sid, price):
-    with model_lock:
-        if not filtering_model or sid not in filtering_model: return False 
-        m = filtering_model[sid]['mean']
-        s = filtering_model[sid]['std_dev']
-        if s == 0: return True
-        # Tolleranza ampia (3 sigma)
-        return (m - 3*s) <= price <= (m + 3*s)
+            data_queue.get_nowait()
+            data_queue.task_done()
+            data_queue.put_nowait(item)
+        except (queue.Empty, queue.Full): pass
+
+def is_clean(sid, price, bounds):
+    """Un sensore senza modello non è mai pulito."""
+    lo_hi = bounds[sid]
+    return lo_hi is not None and lo_hi[0] <= price <= lo_hi[1]
 
 # --- THREADS ---
+BINANCE_SEEN_TRADES = 256 # trade id ricordati per sensore (scarto duplicati)
+# Messaggio di sottoscrizione serializzato una sola volta (riusato a ogni riconnessione)
+_SUB_MSG = json.dumps({"method": "SUBSCRIBE", "params": ["btcusdt@trade", "ethusdt@trade", "solusdt@trade"], "id": 1})
+
+def _on_open(ws):
+    ws.send(_SUB_MSG)
+
+def parse_trade(msg):
+    """Estrae (simbolo, prezzo, timestamp_ms, trade id) da un frame di trade, None se non è un trade."""
+    if _trade_decoder is not None:
+        try:
+            d = _trade_decoder.decode(msg).data
+        except (msgspec.ValidationError, msgspec.DecodeError):
+            return None
+        if d.e != 'trade': return None
+        return d.s, d.p, d.E, d.t
+
+    j = orjson.loads(msg)
+    if 'data' not in j or j['data'].get('e') != 'trade': return None
+    d = j['data']
+    return d['s'], d['p'], d['E'], d['t']
+
 def run_binance():
-    last_ts_map = {}
+    # Dedup per trade id: deque per l'ordine di inserimento (LRU), set per il lookup O(1)
+    seen = [deque(maxlen=BINANCE_SEEN_TRADES) for _ in SID_LABELS]
+    seen_set = [set() for _ in SID_LABELS]
     def on_msg(ws, msg):
         try:
-            j = json.loads(msg)
-            if 'data' not in j or j['data']['e'] != 'trade': return
-            d = j['data']
-            sid = UNIFIED_MAP.get(d['s'].lower())
-            if not sid: return
-            ts = datetime.utcfromtimestamp(d['E']/1000.0)
-            if sid in last_ts_map and last_ts_map[sid] == ts: return 
-            last_ts_map[sid] = ts
-            price = float(d['p'])
-            data_queue.put({"sid": sid, "ts": ts, "p": price, "src": "Binance"})
+            trade = parse_trade(msg)
+            if trade is None: return
+            symbol, price, event_ms, tid = trade
+            sid = UNIFIED_MAP.get(symbol.lower())
+            if sid is None: return
+            ids = seen_set[sid]
+            if tid in ids: return
+            order = seen[sid]
+            if len(order) == BINANCE_SEEN_TRADES:
+                ids.discard(order[0])
+            order.append(tid)
+            ids.add(tid)
+            # Conversione del timestamp solo dopo il dedup
+            ts = datetime.utcfromtimestamp(event_ms/1000.0)
+            price = float(price)
+            enqueue({"sid": sid, "ts": ts, "p": price, "src": "Binance"})
         except: pass
     while True:
         try:
-            ws = websocket.WebSocketApp(BINANCE_WS_URL, on_message=on_msg)
-            ws.on_open = lambda w: w.send(json.dumps({"method": "SUBSCRIBE", "params": ["btcusdt@trade", "ethusdt@trade", "solusdt@trade"], "id": 1}))
-            ws.run_forever()
+            ws = websocket.WebSocketApp(BINANCE_WS_URL, on_open=_on_open, on_message=on_msg)
+            # Frame già JSON UTF-8 dal server: niente validazione UTF-8 lato client
+            ws.run_forever(ping_interval=180, ping_timeout=10, skip_utf8_validation=True)
         except: time.sleep(5)
 
-def run_coinbase():
+async def fetch_coinbase(client, p, ts):
+    try:
+        res = await client.get(COINBASE_API_URL.format(p), timeout=5)
+        if res.status_code == 200:
+            enqueue({"sid": UNIFIED_MAP.get(p), "ts": ts, "p": float(res.json()['data']['amount']), "src": "Coinbase"})
+    except: pass
+
+async def poll_coinbase(client):
     pairs = ["BTC-USD", "ETH-USD", "SOL-USD"]
     while True:
-        for p in pairs:
-            try:
-                res = requests.get(COINBASE_API_URL.format(p), timeout=5)
-                if res.status_code == 200:
-                    data_queue.put({"sid": UNIFIED_MAP.get(p), "ts": datetime.utcnow(), "p": float(res.json()['data']['amount']), "src": "Coinbase"})
-            except: pass
-        time.sleep(5)
+        # Le 3 richieste partono insieme: il ciclo dura quanto la più lenta.
+        # Un solo timestamp per ciclo di polling, condiviso dalle 3 coppie
+        ts = datetime.utcnow()
+        await asyncio.gather(*(fetch_coinbase(client, p, ts) for p in pairs))
+        await asyncio.sleep(5)
 
-def run_coingecko():
+async def poll_coingecko(client):
     params = {"ids": "bitcoin,ethereum,solana", "vs_currencies": "usd"}
     while True:
         try:
-            res = requests.get(COINGECKO_API_URL, params=params, timeout=10)
+            res = await client.get(COINGECKO_API_URL, params=params, timeout=10)
             if res.status_code == 200:
-                for c, v in res.json().items(): data_queue.put({"sid": UNIFIED_MAP.get(c), "ts": datetime.utcnow(), "p": float(v['usd']), "src": "CoinGecko"})
+                ts = datetime.utcnow()
+                for c, v in res.json().items(): enqueue({"sid": UNIFIED_MAP.get(c), "ts": ts, "p": float(v['usd']), "src": "CoinGecko"})
         except: pass
-        time.sleep(20)
+        await asyncio.sleep(20)
+
+async def rest_feeds():
+    # Un solo client HTTP/2 per le API REST: connessioni TCP+TLS riusate e multiplexate
+    async with httpx.AsyncClient(http2=True, timeout=5) as client:
+        await asyncio.gather(poll_coinbase(client), poll_coingecko(client))
+
+def run_rest_feeds():
+    """Coinbase e CoinGecko come task asyncio nello stesso thread."""
+    while True:
+        try: asyncio.run(rest_feeds())
+        except Exception as e:
+            log.error(f"Errore feed REST: {e}")
+            time.sleep(5)
 
 def process_queue():
     """
-    Raccoglie i dati e scrive file BATCH UNIVOCI nella cartella /incoming.
-    EVITA 'append' per prevenire lock HDFS.
+    Raccoglie i dati e consegna i batch all'hdfs_writer, che scrive file BATCH
+    UNIVOCI nella cartella /incoming. Le scritture HDFS non bloccano mai lo svuotamento della coda.
     """
     hdfs_buffer = []
     last_hdfs_flush = time.time()
+    # Riepilogo dei tick ricevuti: (src, sid) -> [conteggio, ultimo prezzo],
+    # scritto nel log una volta al secondo invece di una riga per tick
+    tick_counters = defaultdict(lambda: [0, 0.0])
+    last_tick_log = time.time()
     
     while True:
         try:
+            # Prelievo a blocchi: si attende il primo elemento, poi si svuota fino a QUEUE_DRAIN_SIZE
+            batch = []
             try:
-                item = data_queue.get(timeout=1)
-                sid, ts, price, src = item['sid'], item['ts'], item['p'], item['src']
-                log.info(f"[{src}] -> {sid}: ${price}")
-                
-                # Speed Layer Buffer
-                with buffer_lock: aggregation_buffer[sid].append(price)
-                
-                # Batch Layer Buffer
-                hdfs_buffer.append(json.dumps({
-                    "sensor_id": sid, 
-                    "timestamp": ts.isoformat(), # ISO standard
-                    "temp": price, 
-                    "source": src
-                }) + '\n')
-                
-                data_queue.task_done()
+                batch.append(data_queue.get(timeout=1))
+                while len(batch) < QUEUE_DRAIN_SIZE:
+                    batch.append(data_queue.get_nowait())
             except queue.Empty: pass
 
-            # Logica di Flush: Tempo o Dimensione
-            if len(hdfs_buffer) > 0 and (len(hdfs_buffer) >= HDFS_BATCH_SIZE or (time.time() - last_hdfs_flush > HDFS_FLUSH_INTERVAL)):
-                
-                # Nome file univoco: batch_TIMESTAMP_NANO.jsonl
-                ts_batch = int(time.time() * 1000)
-                filename = f"batch_{ts_batch}.jsonl"
-                full_path = f"{HDFS_INCOMING_DIR}/{filename}"
-                
-                try:
-                    # Write con Overwrite=True (sicuro perché il nome è univoco)
-                    with hdfs_client.write(full_path, encoding='utf-8', overwrite=True) as w:
-                        w.write("".join(hdfs_buffer))
-                    log.info(f"💾 Batch salvato in INCOMING: {filename} ({len(hdfs_buffer)} righe)")
-                    
-                    # --- CLEANUP: Mantieni solo gli ultimi 3 batch ---
-                    cleanup_old_batches()
+            if batch:
+                prices_by_sid = new_aggregation_buffer()
+                for item in batch:
+                    data_queue.task_done()
+                    sid, ts, price, src = item['sid'], item['ts'], item['p'], item['src']
+                    if sid is None: continue # simbolo non mappato
+                    counter = tick_counters[(src, sid)]
+                    counter[0] += 1
+                    counter[1] = price
+                    prices_by_sid[sid].append(price)
                     
-                    hdfs_buffer = []
-                    last_hdfs_flush = time.time()
-                except Exception as e:
-                    log.error(f"Errore scrittura HDFS: {e}")
+                    # Batch Layer Buffer: righe JSON già in bytes (il '\n' lo aggiunge orjson)
+                    hdfs_buffer.append(orjson.dumps({
+                        "sensor_id": SID_LABELS[sid], 
+                        "timestamp": ts, # ISO standard (orjson: stesso formato di isoformat())
+                        "temp": price, 
+                        "source": src
+                    }, option=HDFS_JSON_OPTS))
+
+                # Speed Layer Buffer: un solo extend per sensore
+                with aggregation_lock:
+                    current = aggregation_buffer
+                    for sid, prices in enumerate(prices_by_sid):
+                        if prices: current[sid].extend(prices)
+
+            now = time.time()
+            if now - last_tick_log >= 1.0:
+                if tick_counters and log.isEnabledFor(logging.INFO):
+                    log.info("📈 " + ", ".join(
+                        f"[{src}] {SID_LABELS[sid]} x{n} ${price}" for (src, sid), (n, price) in sorted(tick_counters.items())
+                    ))
+                tick_counters.clear()
+                last_tick_log = now
+
+            # Logica di Flush: Tempo o Dimensione
+            if len(hdfs_buffer) > 0 and (len(hdfs_buffer) >= HDFS_BATCH_SIZE or (now - last_hdfs_flush > HDFS_FLUSH_INTERVAL)):
+                hdfs_write_queue.put(hdfs_buffer)
+                hdfs_buffer = []
+                last_hdfs_flush = now
 
         except Exception as e:
             log.error(f"Errore loop process_queue: {e}")
 
+def hdfs_writer():
+    """Scrive su HDFS i batch consegnati da process_queue; in caso di errore riprova lo stesso batch."""
+    while True:
+        records = hdfs_write_queue.get()
+        # Nome file univoco: batch_TIMESTAMP_NANO.jsonl.gz (stesso nome per tutti i tentativi)
+        ts_batch = int(time.time() * 1000)
+        filename = f"batch_{ts_batch}{HDFS_BATCH_EXT}"
+        full_path = f"{HDFS_INCOMING_DIR}/{filename}"
+        tmp_path = f"{HDFS_INCOMING_DIR}/{HDFS_TMP_PREFIX}batch_{ts_batch}{HDFS_TMP_EXT}"
+        while True:
+            try:
+                # Righe compresse in streaming direttamente nel writer HDFS, senza
+                # materializzare il batch intero; rename atomico a scrittura completata
+                with hdfs_client.write(tmp_path, overwrite=True) as w:
+                    with gzip.GzipFile(fileobj=w, mode='wb', compresslevel=HDFS_GZIP_LEVEL) as gz:
+                        gz.writelines(records)
+                hdfs_client.rename(tmp_path, full_path)
+                log.info(f"💾 Batch salvato in INCOMING: {filename} ({len(records)} righe)")
+                
+                # --- CLEANUP: Mantieni solo gli ultimi 3 batch ---
+                register_batch(filename)
+                break
+            except Exception as e:
+                log.error(f"Errore scrittura HDFS: {e}")
+                if discard_partial_batch(tmp_path, full_path):
+                    # Il rename era andato a buon fine: niente nuovo tentativo (eviterebbe un duplicato)
+                    register_batch(filename)
+                    break
+                time.sleep(5)
+
+def discard_partial_batch(tmp_path, full_path):
+    """
+    Dopo un errore: cancella l'eventuale file temporaneo troncato.
+    True se il batch risulta comunque già pubblicato col nome finale.
+    """
+    try:
+        hdfs_client.delete(tmp_path)
+        return hdfs_client.status(full_path, strict=False) is not None
+    except Exception as e:
+        log.warning(f"Impossibile ripulire {tmp_path}: {e}")
+        return False
+
+def seed_minute_totals(acc, label):
+    """
+    Somma alla finestra corrente la riga del minuto già scritta da un'istanza
+    precedente (riavvio a metà minuto). False se la lettura non è riuscita.
+    """
+    try:
+        row = cassandra_session.execute(cassandra_minute_select, (label, acc[0]), timeout=CASSANDRA_WRITE_TIMEOUT).one()
+    except Exception as e:
+        log.error(f"Lettura minuto {label} non riuscita (nuovo tentativo alla prossima finestra): {e}")
+        return False
+    if row is not None and row.temp_count:
+        acc[1] += row.temp_sum
+        acc[2] += row.temp_count
+    return True
+
 def process_aggregates():
-    global discard_counter
+    global discard_total, aggregation_buffer
     last_wait_log = 0 
+    # Somma/conteggio del minuto corrente per sensore: [minuto, somma, conteggio, letto].
+    # La riga in sensor_data_minute viene sovrascritta a ogni finestra (upsert
+    # idempotente, niente counter/LWT); il primo minuto dopo l'avvio parte dalla
+    # riga già presente, così un riavvio non ne azzera somma e conteggio
+    minute_totals = [None] * len(SID_LABELS)
     while True:
         time.sleep(AGGREGATION_WINDOW)
-        has_model = False
-        with model_lock:
-            if filtering_model: has_model = True
+        bounds = filtering_model_bounds
         
-        if not has_model:
-            with buffer_lock: aggregation_buffer.clear()
+        if bounds is None:
+            with aggregation_lock: aggregation_buffer = new_aggregation_buffer()
             if time.time() - last_wait_log > 30: 
                 log.info("⏳ In attesa del modello (Calibrazione)...")
                 last_wait_log = time.time()
             continue
             
-        current_data = {}
-        with buffer_lock:
-            for k, v in aggregation_buffer.items():
-                if v: current_data[k] = v[:]
-            aggregation_buffer.clear()
+        # Scambio del buffer: i nuovi tick finiscono in quello appena creato
+        with aggregation_lock:
+            current, aggregation_buffer = aggregation_buffer, new_aggregation_buffer()
         
         ts_now = datetime.utcnow()
-        for sid, prices in current_data.items():
-            avg = sum(prices) / len(prices)
-            if is_clean(sid, avg):
-                try: cassandra_session.execute(cassandra_query, (sid, ts_now, avg))
-                except: pass
+        # Tutte le scritture della finestra in un solo batch UNLOGGED (righe indipendenti):
+        # un unico round-trip verso il coordinator
+        batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+        for sid, prices in enumerate(current):
+            if not prices: continue
+            avg = math.fsum(prices) / len(prices)
+            if is_clean(sid, avg, bounds):
+                minute_ts = ts_now.replace(second=0, microsecond=0)
+                acc = minute_totals[sid]
+                if not acc or acc[0] != minute_ts:
+                    # Dal secondo minuto in poi la riga nasce da questa istanza: nessuna lettura
+                    acc = minute_totals[sid] = [minute_ts, 0.0, 0, acc is not None]
+                acc[1] += avg
+                acc[2] += 1
+                label = SID_LABELS[sid]
+                batch.add(cassandra_query, (label, ts_now, avg))
+                if not acc[3]:
+                    acc[3] = seed_minute_totals(acc, label)
+                # Finché la riga esistente non è stata letta non la si sovrascrive
+                if acc[3]:
+                    batch.add(cassandra_minute_query, (label, minute_ts, acc[1], acc[2]))
             else:
-                with discard_lock: discard_counter += 1
-                log.info(f"⚠️ Anomalia scartata (Speed Layer): {sid} - ${avg:.2f}")
+                discard_total += 1
+                log.info(f"⚠️ Anomalia scartata (Speed Layer): {SID_LABELS[sid]} - ${avg:.2f}")
+        if len(batch) == 0: continue
+        try:
+            # Il timeout va passato alla richiesta: result() attende al massimo CASSANDRA_WRITE_TIMEOUT
+            cassandra_session.execute_async(batch, timeout=CASSANDRA_WRITE_TIMEOUT).result()
+        except Exception as e:
+            log.error(f"Errore scrittura Cassandra: {e}")
+
+def run_periodic(interval, task):
+    """Esegue subito il task e poi una volta ogni 'interval' secondi."""
+    while True:
+        try: task()
+        except Exception as e: log.error(f"Errore task periodico {task.__name__}: {e}")
+        time.sleep(interval)
 
 def main():
     setup_connections()
     init_discard_stats()
+    # Il totale non salvato dall'ultimo flush va scritto anche in chiusura
+    atexit.register(flush_discard_stats)
+    # docker stop invia SIGTERM: uscita pulita così gli handler atexit vengono eseguiti
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     
     threading.Thread(target=run_binance, daemon=True).start()
-    threading.Thread(target=run_coinbase, daemon=True).start()
-    threading.Thread(target=run_coingecko, daemon=True).start()
+    threading.Thread(target=run_rest_feeds, daemon=True).start()
     threading.Thread(target=process_queue, daemon=True).start()
+    threading.Thread(target=hdfs_writer, daemon=True).start()
     threading.Thread(target=process_aggregates, daemon=True).start()
 
-    log.info("🚀 Unified Producer Avviato (Mode: Incremental)")
+    threading.Thread(target=run_periodic, args=(MODEL_REFRESH_INTERVAL, update_model), daemon=True).start()
+    threading.Thread(target=run_periodic, args=(STATS_FLUSH_INTERVAL, flush_discard_stats), daemon=True).start()
 
-    last_chk = 0
-    last_stats_flush = 0
+    log.info("🚀 Unified Producer Avviato (Mode: Incremental)")
 
-    while True:
-        time.sleep(1) 
-        now = time.time()
-        if now - last_chk > 60:
-            update_model()
-            last_chk = now
-        if now - last_stats_flush > STATS_FLUSH_INTERVAL:
-            flush_discard_stats()
-            last_stats_flush = now
+    # Il main thread resta fermo senza risvegli periodici (SIGTERM lo interrompe)
+    threading.Event().wait()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
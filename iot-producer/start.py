@@ -31,6 +31,25 @@ CREATE TABLE IF NOT EXISTS iot_keyspace.sensor_data (
 ) WITH CLUSTERING ORDER BY (timestamp DESC);
 """
 
+CQL_CREATE_MINUTE_TABLE = """
+CREATE TABLE IF NOT EXISTS iot_keyspace.sensor_data_minute (
+  sensor_id TEXT,
+  minute_ts TIMESTAMP,
+  temp_sum DOUBLE,
+  temp_count INT,
+  PRIMARY KEY (sensor_id, minute_ts)
+) WITH CLUSTERING ORDER BY (minute_ts ASC);
+"""
+
+CQL_CREATE_SUMMARY_TABLE = """
+CREATE TABLE IF NOT EXISTS iot_keyspace.sensor_daily_summary (
+  sensor_id TEXT,
+  day TEXT,
+  metrics TEXT,
+  PRIMARY KEY (sensor_id, day)
+);
+"""
+
 def initialize_cassandra():
     """
     Si connette al cluster (senza keyspace) ed esegue i comandi CQL
@@ -62,8 +81,16 @@ def initialize_cassandra():
         # 2. Crea la Tabella
         log.info("Esecuzione: Creazione Tabella 'sensor_data'")
         session.execute(CQL_CREATE_TABLE)
+
+        # 3. Crea la Tabella di riepilogo per minuto
+        log.info("Esecuzione: Creazione Tabella 'sensor_data_minute'")
+        session.execute(CQL_CREATE_MINUTE_TABLE)
+
+        # 4. Crea la Tabella delle metriche giornaliere (Batch Layer)
+        log.info("Esecuzione: Creazione Tabella 'sensor_daily_summary'")
+        session.execute(CQL_CREATE_SUMMARY_TABLE)
         
-        log.info("Keyspace 'iot_keyspace' e tabella 'sensor_data' creati/verificati.")
+        log.info("Keyspace 'iot_keyspace' e tabelle 'sensor_data', 'sensor_data_minute', 'sensor_daily_summary' creati/verificati.")
     
     except Exception as e:
         log.error(f"Errore durante l'esecuzione di CQL: {e}")